@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+try:
+    from .embed_store import EMBEDS_FILE, convert_chunks, has_store, open_store, select_top
+except ImportError:
+    from embed_store import EMBEDS_FILE, convert_chunks, has_store, open_store, select_top
+
+
+CENTROIDS_FILE = 'ivf_centroids.npy'
+OFFSETS_FILE = 'ivf_offsets.npy'
+ROWS_FILE = 'ivf_rows.npy'
+META_FILE = 'ivf_meta.json'
+
+ASSIGN_BLOCK_ROWS = 65536
+
+
+def _as_query(preference_embed):
+    if isinstance(preference_embed, torch.Tensor):
+        preference_embed = preference_embed.detach().cpu().numpy()
+    return np.asarray(preference_embed, dtype=np.float32).reshape(-1)
+
+
+def _assign(embeds, centroids):
+    labels = np.empty(len(embeds), dtype=np.int64)
+    for start in range(0, len(embeds), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(embeds[start: start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        labels[start: start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def train_centroids(embeds, nlist, num_iters=10, sample_size=100000, seed=0):
+    # spherical k-means: embeddings are L2-normalized, so assignment is by inner product
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(len(embeds), min(sample_size, len(embeds)), replace=False))
+    sample = np.asarray(embeds[sample_rows], dtype=np.float32)
+
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(num_iters):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=nlist)
+
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+
+def build_ivf_index(vector_dir: os.PathLike, nlist: int = None, num_iters: int = 10, seed: int = 0):
+    if not has_store(vector_dir):
+        convert_chunks(vector_dir)
+    store = open_store(vector_dir)
+
+    num_users = len(store)
+    nlist = nlist or max(1, int(np.sqrt(num_users)))
+    nlist = min(nlist, num_users)
+
+    # the store decodes float16 / int8 rows to float32 on indexing
+    centroids = train_centroids(store, nlist, num_iters=num_iters, seed=seed)
+    labels = _assign(store, centroids)
+    rows = np.argsort(labels, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+
+    np.save(os.path.join(vector_dir, CENTROIDS_FILE), centroids)
+    np.save(os.path.join(vector_dir, OFFSETS_FILE), offsets)
+    np.save(os.path.join(vector_dir, ROWS_FILE), rows)
+    with open(os.path.join(vector_dir, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({
+            "nlist": nlist,
+            "num_users": num_users,
+            "store_mtime_ns": os.stat(os.path.join(vector_dir, EMBEDS_FILE)).st_mtime_ns
+        }, f)
+    print(f"[!] built IVF index over {num_users} users with {nlist} lists")
+
+
+class IVFIndex:
+    def __init__(self, vector_dir: os.PathLike):
+        self.store = open_store(vector_dir)
+        self.centroids = np.load(os.path.join(vector_dir, CENTROIDS_FILE))
+        self.offsets = np.load(os.path.join(vector_dir, OFFSETS_FILE))
+        self.rows = np.load(os.path.join(vector_dir, ROWS_FILE))
+        self.nlist = len(self.centroids)
+
+    def search(self, preference_embed, k, nprobe=8, exclude_rows=None):
+        query = _as_query(preference_embed)
+        nprobe = max(1, nprobe)
+
+        # probing every list is just an exact scan, skip the gather
+        if nprobe >= self.nlist:
+            sims = self.store.scores(query)
+            candidates = np.arange(len(sims))
+        else:
+            probe = np.argpartition(-(self.centroids @ query), nprobe)[:nprobe]
+            candidates = np.sort(np.concatenate([self.rows[self.offsets[c]: self.offsets[c + 1]] for c in probe]))
+            sims = self.store[candidates] @ query
+
+        if exclude_rows is not None and len(exclude_rows):
+            sims[np.isin(candidates, exclude_rows)] = -np.inf
+        top = select_top(sims, k)
+        return candidates[top], sims[top]
+
+
+def has_ivf_index(vector_dir: os.PathLike):
+    meta_file = os.path.join(vector_dir, META_FILE)
+    if not os.path.exists(meta_file) or not has_store(vector_dir):
+        return False
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    # an index built against an older store would point at the wrong rows
+    return meta['store_mtime_ns'] == os.stat(os.path.join(vector_dir, EMBEDS_FILE)).st_mtime_ns
+
+
+_indexes = {}
+
+
+def open_ivf_index(vector_dir: os.PathLike):
+    mtime = os.stat(os.path.join(vector_dir, META_FILE)).st_mtime_ns
+    cached = _indexes.get(vector_dir)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, IVFIndex(vector_dir))
+        _indexes[vector_dir] = cached
+    return cached[1]
+
+
+def evaluate(vector_dir: os.PathLike, k: int, nprobes, num_queries: int = 100, seed: int = 0):
+    index = open_ivf_index(vector_dir)
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(index.store[np.sort(rng.choice(len(index.store), min(num_queries, len(index.store)), replace=False))], dtype=np.float32)
+
+    exact = [set(index.search(q, k, nprobe=index.nlist)[0].tolist()) for q in queries]
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        results = [index.search(q, k, nprobe=nprobe)[0] for q in queries]
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(exact_set.intersection(r.tolist())) / len(exact_set) for exact_set, r in zip(exact, results)])
+        print(f"nprobe={nprobe:<4d} recall@{k}={recall:.4f} latency={latency:.3f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectorized-follower-dir', type=str, required=True)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--num-iters', type=int, default=10)
+    parser.add_argument('--eval-k', type=int, default=10)
+    parser.add_argument('--eval-nprobe', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--skip-build', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_build:
+        build_ivf_index(args.vectorized_follower_dir, args.nlist, args.num_iters)
+    evaluate(args.vectorized_follower_dir, args.eval_k, args.eval_nprobe)
@@ -2,89 +2,214 @@ import os
 import json
 import torch
 import argparse
+import numpy as np
 import torch.nn.functional as F
 
+try:
+    from .embed_store import SCORE_BLOCK_ROWS, has_store, live_rows, load_chunk_embeddings, load_chunk_index, load_chunk_info, open_store, select_top
+    from .ann_index import has_ivf_index, open_ivf_index
+    from .pq_index import has_pq_index, open_pq_index
+except ImportError:
+    from embed_store import SCORE_BLOCK_ROWS, has_store, live_rows, load_chunk_embeddings, load_chunk_index, load_chunk_info, open_store, select_top
+    from ann_index import has_ivf_index, open_ivf_index
+    from pq_index import has_pq_index, open_pq_index
+
 
 def get_user_preference_embedding(followers, vector_dir: os.PathLike):
-    preference_embedding = None
-    
-    index_file = os.path.join(vector_dir, 'index.json')
-    with open(index_file, 'r+', encoding='utf-8') as f:
-        user_index = json.load(f)
-    
-    chunk_ids = []
-    for follower in followers:
-        if follower in user_index and user_index[follower] not in chunk_ids:
-            chunk_ids.append(user_index[follower])
-    
-    for chunk_id in chunk_ids:
-        chunk_info_file = os.path.join(vector_dir, f"chunk_info_{chunk_id:>04d}.json")
-        with open(chunk_info_file, 'r+', encoding='utf-8') as f:
-            chunk_info = json.load(f)
-            
-        chunk_file = os.path.join(vector_dir, f"chunk_{chunk_id:>04d}.bin")
-        chunk_embed = torch.load(chunk_file)
+    # normalized sum of the listed followers' embeddings (same as batch mode), None if none is vectorized
+    if not has_store(vector_dir):
+        preference_embeds, valid = get_preference_embeddings([followers], vector_dir)
+        return preference_embeds[valid] if valid else None
+
+    store = open_store(vector_dir)
+    rows = store.rows_of(followers)
+    if len(rows) == 0:
+        return None
+    # one gather over the memory-mapped matrix, rows sorted for locality
+    rows.sort()
+    preference_embedding = store[rows].sum(axis=0, keepdims=True)
+    return F.normalize(torch.from_numpy(preference_embedding), p=2, dim=1)
+
+
+def get_user_embeddings(users, vector_dir: os.PathLike):
+    # embeddings of the given users that are vectorized, in input order, always on CPU
+    if has_store(vector_dir):
+        store = open_store(vector_dir)
+        rows = store.lookup(users)
+        found = [user for user, row in zip(users, rows) if row >= 0]
+        return found, torch.from_numpy(store[rows[rows >= 0]])
 
-        for follower in followers:
-            if follower in chunk_info['users']:
-                follower_index = chunk_info['users'].index(follower)
-            follower_embed = chunk_embed[follower_index]
-            if preference_embedding is not None:
-                preference_embedding += follower_embed
-            else:
-                preference_embedding = follower_embed
-    preference_embedding = F.normalize(preference_embedding.unsqueeze(0), p=2, dim=1)
-    return preference_embedding
+    return load_chunk_embeddings(vector_dir, users)
 
 
 def cosine_similarity_matching(preference_embed, vector_dir: os.PathLike):
-    index_file = os.path.join(vector_dir, 'index.json')
-    with open(index_file, 'r+', encoding='utf-8') as f:
-        user_index = json.load(f)
+    if has_store(vector_dir):
+        store = open_store(vector_dir)
+        return {"users": store.users, "sims": store.scores(preference_embed).tolist()}
+
+    user_index = load_chunk_index(vector_dir)
         
     user_sim = {"users": [], "sims": []}
     num_chunks = max([chunk_index for _, chunk_index in user_index.items()]) + 1
     
     for chunk_id in range(num_chunks):
-        chunk_info_file = os.path.join(vector_dir, f"chunk_info_{chunk_id:>04d}.json")
-        with open(chunk_info_file, 'r+', encoding='utf-8') as f:
-            chunk_info = json.load(f)
+        chunk_info = load_chunk_info(vector_dir, chunk_id)
+        rows = live_rows(chunk_info)
             
         chunk_file = os.path.join(vector_dir, f"chunk_{chunk_id:>04d}.bin")
-        chunk_embed = torch.load(chunk_file)
+        chunk_embed = torch.load(chunk_file, map_location='cpu')[rows]
         
-        cosine_sim = preference_embed @ chunk_embed.T
-        cosine_sim = cosine_sim.squeeze().cpu().numpy().tolist()
+        cosine_sim = preference_embed.to(chunk_embed.device) @ chunk_embed.T
+        cosine_sim = cosine_sim.reshape(-1).cpu().numpy().tolist()
 
-        user_sim['users'].extend(chunk_info['users'])
+        user_sim['users'].extend(chunk_info['users'][row] for row in rows)
         user_sim['sims'].extend(cosine_sim)
         del chunk_embed
         
     return user_sim
 
 
+def top_k(preference_embed, vector_dir: os.PathLike, k: int, exclude=None, nprobe: int = None, rerank: int = None, pq: bool = False):
+    # excluded users are masked before selection, so exactly k (when available) others come back;
+    # with rerank, the best `rerank` candidates of a float16 / int8 store (or of the PQ codes) are rescored in float32
+    exclude = exclude or set()
+    num_candidates = max(k, rerank or 0)
+    if pq and has_pq_index(vector_dir):
+        index = open_pq_index(vector_dir)
+        store = index.store
+        rows, sims = index.search(preference_embed, num_candidates, exclude_rows=store.rows_of(exclude), rerank=rerank)
+    elif nprobe is not None and has_ivf_index(vector_dir):
+        index = open_ivf_index(vector_dir)
+        store = index.store
+        rows, sims = index.search(preference_embed, num_candidates, nprobe=nprobe, exclude_rows=store.rows_of(exclude))
+    elif has_store(vector_dir):
+        store = open_store(vector_dir)
+        sims = store.scores(preference_embed)
+        sims[store.rows_of(exclude)] = -np.inf
+        rows = select_top(sims, num_candidates)
+        sims = sims[rows]
+    else:
+        user_sim = cosine_similarity_matching(preference_embed, vector_dir)
+        users = user_sim['users']
+        sims = np.asarray(user_sim['sims'], dtype=np.float32).reshape(-1)
+        sims[[i for i, user in enumerate(users) if user in exclude]] = -np.inf
+        top = select_top(sims, k)
+        return {"users": [users[i] for i in top], "sims": sims[top].tolist()}
+
+    if rerank:
+        rows, sims = store.rerank(preference_embed, rows, sims)
+    return {"users": [store.users[row] for row in rows[:k]], "sims": sims[:k].tolist()}
+
+
+def get_preference_embeddings(follower_lists, vector_dir: os.PathLike):
+    # every distinct follower is looked up once, then each preference is a gather-and-sum
+    all_followers = list(dict.fromkeys(follower for followers in follower_lists for follower in followers))
+    found, embeds = get_user_embeddings(all_followers, vector_dir)
+    positions = {user: i for i, user in enumerate(found)}
+
+    preference_embeds = torch.zeros(len(follower_lists), embeds.shape[1] if embeds is not None else 0)
+    valid = []
+    for i, followers in enumerate(follower_lists):
+        rows = [positions[follower] for follower in followers if follower in positions]
+        if rows:
+            preference_embeds[i] = embeds[rows].sum(dim=0)
+            valid.append(i)
+    return F.normalize(preference_embeds, p=2, dim=1), valid
+
+
+def _iter_embedding_blocks(vector_dir: os.PathLike):
+    if has_store(vector_dir):
+        store = open_store(vector_dir)
+        for start in range(0, len(store), SCORE_BLOCK_ROWS):
+            yield store.users[start: start + SCORE_BLOCK_ROWS], store[start: start + SCORE_BLOCK_ROWS]
+        return
+
+    user_index = load_chunk_index(vector_dir)
+    num_chunks = max(user_index.values()) + 1
+    for chunk_id in range(num_chunks):
+        chunk_info = load_chunk_info(vector_dir, chunk_id)
+        rows = live_rows(chunk_info)
+        chunk_embed = torch.load(os.path.join(vector_dir, f"chunk_{chunk_id:>04d}.bin"), map_location='cpu')
+        yield [chunk_info['users'][row] for row in rows], chunk_embed[rows].float().numpy()
+
+
+def batch_top_k(preference_embeds, vector_dir: os.PathLike, k: int, excludes=None):
+    # one (num_users x block) matrix product per block, keeping a running top-k per user
+    if isinstance(preference_embeds, torch.Tensor):
+        preference_embeds = preference_embeds.detach().cpu().numpy()
+    preference_embeds = np.asarray(preference_embeds, dtype=np.float32)
+    num_queries = len(preference_embeds)
+    excludes = excludes or [set()] * num_queries
+
+    users = []
+    best_sims = np.empty((num_queries, 0), dtype=np.float32)
+    best_rows = np.empty((num_queries, 0), dtype=np.int64)
+    for block_users, block_embeds in _iter_embedding_blocks(vector_dir):
+        block_sims = preference_embeds @ block_embeds.T
+        block_positions = {user: i for i, user in enumerate(block_users)}
+        for i, exclude in enumerate(excludes):
+            block_sims[i, [block_positions[user] for user in exclude if user in block_positions]] = -np.inf
+
+        block_rows = np.broadcast_to(np.arange(len(users), len(users) + len(block_users)), block_sims.shape)
+        users.extend(block_users)
+        best_sims = np.concatenate([best_sims, block_sims], axis=1)
+        best_rows = np.concatenate([best_rows, block_rows], axis=1)
+        if best_sims.shape[1] > k:
+            keep = np.argpartition(-best_sims, k - 1, axis=1)[:, :k]
+            best_sims = np.take_along_axis(best_sims, keep, axis=1)
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+    results = []
+    for sims, rows in zip(best_sims, best_rows):
+        top = select_top(sims, k)
+        results.append({"users": [users[row] for row in rows[top]], "sims": sims[top].tolist()})
+    return results
+
+
+def print_ranking(screen_name, ranking):
+    print(f"[!] target user: {screen_name}")
+    print(f"Preference ranking:")
+    for i, (user, sim) in enumerate(zip(ranking['users'], ranking['sims'])):
+        print(f"{i + 1}. {user}: {round(sim, 4)}")
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--user-file', type=str, required=True)
+    user_source = parser.add_mutually_exclusive_group(required=True)
+    user_source.add_argument('--user-file', type=str)
+    user_source.add_argument('--user-dir', type=str, help='score every user file in this directory in one batch')
     parser.add_argument('--vectorized-follower-dir', type=str, required=True)
     parser.add_argument('--num-recommend', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, default=None, help='search the IVF index (see ann_index.py) with this many lists')
+    parser.add_argument('--rerank', type=int, default=None, help='rescore this many candidates of a float16 / int8 store in float32')
+    parser.add_argument('--pq', action='store_true', help='scan the product-quantization codes (see pq_index.py)')
     args = parser.parse_args()
-    
-    with open(args.user_file, 'r+', encoding='utf-8') as f:
-        info = json.load(f)
-        followers = [follower['name'] for follower in info['followers']]
-        
-    pref_embed = get_user_preference_embedding(followers, args.vectorized_follower_dir)
-    sims = cosine_similarity_matching(pref_embed, args.vectorized_follower_dir)
 
-    print(f"[!] target user: {info['profile']['screen_name']}")
-    print(f"Preference ranking:")
-    rank = torch.argsort(torch.tensor(sims['sims']), descending=True).numpy().tolist()
-    counter = 0
-    for i, index in enumerate(rank):
-        if sims['users'][index] in followers:
-            continue
-        print(f"{counter + 1}. {sims['users'][index]}: {round(sims['sims'][index], 4)}")
-        counter += 1
-        if counter >= args.num_recommend:
-            break
+    if args.user_dir is not None:
+        infos = []
+        for entry in sorted(os.listdir(args.user_dir)):
+            abs_path = os.path.join(args.user_dir, entry)
+            if os.path.isfile(abs_path) and abs_path.endswith('.json'):
+                with open(abs_path, 'r+', encoding='utf-8') as f:
+                    info = json.load(f)
+                if 'followers' in info:
+                    infos.append(info)
+
+        follower_lists = [[follower['name'] for follower in info['followers']] for info in infos]
+        pref_embeds, valid = get_preference_embeddings(follower_lists, args.vectorized_follower_dir)
+        rankings = batch_top_k(pref_embeds[valid], args.vectorized_follower_dir, args.num_recommend,
+                               excludes=[set(follower_lists[i]) for i in valid])
+        for i, ranking in zip(valid, rankings):
+            print_ranking(infos[i]['profile']['screen_name'], ranking)
+            print()
+    else:
+        with open(args.user_file, 'r+', encoding='utf-8') as f:
+            info = json.load(f)
+            followers = [follower['name'] for follower in info['followers']]
+
+        # same gather-and-sum as --user-dir, so both modes rank a user identically
+        pref_embeds, valid = get_preference_embeddings([followers], args.vectorized_follower_dir)
+        if not valid:
+            raise SystemExit(f"[!] none of the followers of {info['profile']['screen_name']} are vectorized")
+        sims = top_k(pref_embeds[valid], args.vectorized_follower_dir, args.num_recommend, exclude=set(followers), nprobe=args.nprobe, rerank=args.rerank, pq=args.pq)
+        print_ranking(info['profile']['screen_name'], sims)
@@ -0,0 +1,83 @@
+import os
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+TAG_PATTERN = re.compile('\\<.*?\\>')
+
+
+def load_json(path: os.PathLike):
+    # orjson parses the raw bytes several times faster than the stdlib when it is installed
+    with open(path, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def extract_tweet_text(item):
+    # returns None for records without usable text
+    try:
+        data = item['mblog']['page_info']
+        return (data['title'] or '') + (data['content2'] or '')
+    except KeyError:
+        try:
+            return TAG_PATTERN.sub('', item['mblog']['text'])
+        except KeyError:
+            return None
+
+
+def project_follow_profile(path: os.PathLike):
+    # what the collaborative filtering pipeline reads from a target user: followed names and tweet authors
+    info = load_json(path)
+    tweets = []
+    for tweet in info.get('tweets', []):
+        if tweet and 'mblog' in tweet and 'user' in tweet['mblog'] and 'screen_name' in tweet['mblog']['user']:
+            tweets.append({'mblog': {'user': {'screen_name': tweet['mblog']['user']['screen_name']}}})
+    return {
+        'followers': [{'name': follower['name']} for follower in info.get('followers', [])],
+        'tweets': tweets
+    }
+
+
+def project_screen_name(path: os.PathLike):
+    info = load_json(path)
+    return {'profile': {'screen_name': info.get('profile', {}).get('screen_name')}}
+
+
+def iter_projected(paths, project, workers: int = None):
+    # yields project(path) in input order; projection runs in the worker so only the
+    # projected fields cross the process boundary, and at most 4 x workers files are in flight
+    paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield project(path)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = []
+        for path in paths:
+            in_flight.append(executor.submit(project, path))
+            if len(in_flight) >= 4 * workers:
+                yield in_flight.pop(0).result()
+        for future in in_flight:
+            yield future.result()
+
+
+def load_projected_dir(user_dir: os.PathLike, project, workers: int = None, skip_prefix: str = None):
+    # {file name without .json: project(path)} for every json file in user_dir
+    names = []
+    paths = []
+    for entry in sorted(os.listdir(user_dir)):
+        abs_path = os.path.join(user_dir, entry)
+        if entry.endswith('.json') and os.path.isfile(abs_path) and not (skip_prefix and entry.startswith(skip_prefix)):
+            names.append(entry[:-5])
+            paths.append(abs_path)
+    return dict(zip(names, iter_projected(paths, project, workers)))
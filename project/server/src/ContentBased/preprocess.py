@@ -1,69 +1,100 @@
 import os
-import re
-import json
+from functools import partial
 
+try:
+    from .json_loader import extract_tweet_text, iter_projected, load_json
+    from .snapshot import current_snapshot, open_snapshot
+except ImportError:
+    from json_loader import extract_tweet_text, iter_projected, load_json
+    from snapshot import current_snapshot, open_snapshot
 
-def load_user_info(user_dir: os.PathLike):
-    user_files = {}
-    for entry in os.listdir(user_dir):
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def iter_user_files(user_dir: os.PathLike):
+    for entry in sorted(os.listdir(user_dir)):
         abs_path = os.path.join(user_dir, entry)
         if os.path.isfile(abs_path) and abs_path.endswith('.json'):
-            user_name = entry.split('.')[0]
-            user_files[user_name] = abs_path
-    
-    user_info = {}
-    for user_name, user_file in user_files.items():
-        with open(user_file, 'r+', encoding='utf-8') as f:
-            info = json.load(f)
-            user_info[user_name] = info
-    
+            yield entry.split('.')[0], abs_path
+
+
+def load_user_info(user_dir: os.PathLike, workers: int = 1):
+    user_files = dict(iter_user_files(user_dir))
+    user_info = dict(zip(user_files.keys(), iter_projected(user_files.values(), load_json, workers)))
+
     return user_info
 
 
-def load_user_feature_text(user_dir: os.PathLike):
-    user_info = load_user_info(user_dir)
-    
-    feature_dict = {}
+def iter_tweets(user_file: os.PathLike, incremental: bool = None):
+    # with ijson only one tweet is materialized at a time instead of the whole profile
+    if incremental is None:
+        incremental = ijson is not None
+    if incremental:
+        with open(user_file, 'rb') as f:
+            yield from ijson.items(f, 'tweets.item')
+    else:
+        yield from load_json(user_file)['tweets']
+
+
+def load_single_feature_text(user_file: os.PathLike, incremental: bool = None):
+    parts = []
+    invalid_counter = 0
+    total_counter = 0
+    for item in iter_tweets(user_file, incremental):
+        total_counter += 1
+        if item is None:
+            continue
+        profile_text = extract_tweet_text(item)
+        if profile_text is None:
+            invalid_counter += 1
+            continue
+        parts.append(profile_text)
+    return ''.join(parts), invalid_counter, total_counter
+
+
+def iter_user_feature_text(user_dir: os.PathLike, incremental: bool = None, workers: int = 1, snapshot_dir: os.PathLike = None):
+    # yields (user, feature_text) one file at a time, memory stays bounded by a single profile
+    # (per worker when files are parsed in a process pool); a compiled snapshot (see snapshot.py) skips json entirely
+    snapshot_dir = current_snapshot(snapshot_dir)
+    if snapshot_dir is not None:
+        snapshot = open_snapshot(snapshot_dir)
+        results = ((snapshot.profile_name(profile).split('.')[0], snapshot.feature_text(profile)) for profile in snapshot.profiles_in(user_dir))
+    else:
+        user_files = dict(iter_user_files(user_dir))
+        results = zip(user_files.keys(), iter_projected(user_files.values(), partial(load_single_feature_text, incremental=incremental), workers))
     invalid_counter = 0
     total_counter = 0
-    for user, info in user_info.items():
-        feature_dict[user] = ''
-        total_counter += len(info['tweets'])
-        for item in info['tweets']:
-            if item is None:
-                continue
-            try:
-                data = item['mblog']['page_info']
-                if data['title'] is None:
-                    data['title'] = ''
-                if data['content2'] is None:
-                    data['content2'] = ''
-                profile_text = data['title'] + data['content2']
-            except KeyError:
-                try:
-                    data = item['mblog']['text']
-                    profile_text = re.sub('\<.*?\>', '', data)
-                except KeyError:
-                    invalid_counter += 1
-                    profile_text = ''
-
-            # Build user feature text
-            feature_dict[user] += profile_text
+    for user_name, (feature, invalid, total) in results:
+        invalid_counter += invalid
+        total_counter += total
+        yield user_name, feature
 
     print(f"[!] Invalid records in {user_dir}: {invalid_counter} / {total_counter}")
-    
+
+
+def load_user_feature_text(user_dir: os.PathLike, incremental: bool = None, workers: int = 1, snapshot_dir: os.PathLike = None):
+    feature_dict = dict(iter_user_feature_text(user_dir, incremental, workers, snapshot_dir))
+
     return {
         "users": list(feature_dict.keys()),
         "features": list(feature_dict.values())
     }
 
 
-def load_user_followers(user_dir: os.PathLike):
-    user_info = load_user_info(user_dir)
-    
-    follower_dict = {}
-    for user, info in user_info.items():
-        follower_dict[user] = [follower['name'] for follower in info['followers']]
-        
+def project_follower_names(user_file: os.PathLike):
+    return [follower['name'] for follower in load_json(user_file)['followers']]
+
+
+def load_user_followers(user_dir: os.PathLike, workers: int = 1, snapshot_dir: os.PathLike = None):
+    snapshot_dir = current_snapshot(snapshot_dir)
+    if snapshot_dir is not None:
+        snapshot = open_snapshot(snapshot_dir)
+        return {snapshot.profile_name(profile).split('.')[0]: snapshot.follows(profile) for profile in snapshot.profiles_in(user_dir)}
+
+    user_files = dict(iter_user_files(user_dir))
+    follower_dict = dict(zip(user_files.keys(), iter_projected(user_files.values(), project_follower_names, workers)))
+
     return follower_dict
-    
\ No newline at end of file
@@ -0,0 +1,306 @@
+import os
+import json
+import argparse
+import numpy as np
+
+try:
+    from .json_loader import extract_tweet_text, iter_projected, load_json
+except ImportError:
+    from json_loader import extract_tweet_text, iter_projected, load_json
+
+
+# every string (file names, followed names, screen names, tweet authors) is interned once
+NAMES_FILE = 'names.bin'
+NAME_OFFSETS_FILE = 'name_offsets.npy'
+# one row per profile file
+PROFILE_NAMES_FILE = 'profile_names.npy'
+PROFILE_SOURCES_FILE = 'profile_sources.npy'
+PROFILE_SCREEN_NAMES_FILE = 'profile_screen_names.npy'
+PROFILE_MTIMES_FILE = 'profile_mtimes.npy'
+PROFILE_TWEETS_FILE = 'profile_tweets.npy'
+# CSR follow edges: followed name ids of profile p are follow_ids[follow_offsets[p]: follow_offsets[p + 1]]
+FOLLOW_OFFSETS_FILE = 'follow_offsets.npy'
+FOLLOW_IDS_FILE = 'follow_ids.npy'
+# posts of profile p are post rows post_offsets[p]: post_offsets[p + 1], texts live in one utf-8 blob
+POST_OFFSETS_FILE = 'post_offsets.npy'
+TEXT_FILE = 'post_text.bin'
+TEXT_OFFSETS_FILE = 'text_offsets.npy'
+POST_AUTHORS_FILE = 'post_authors.npy'
+POST_VALID_FILE = 'post_valid.npy'
+META_FILE = 'snapshot_meta.json'
+
+
+def project_snapshot_profile(path: os.PathLike):
+    # runs in the parser workers, only the fields some pipeline reads are kept
+    info = load_json(path)
+    posts = []
+    tweets = info.get('tweets', [])
+    for tweet in tweets:
+        if tweet is None:
+            continue
+        text = extract_tweet_text(tweet)
+        try:
+            author = tweet['mblog']['user']['screen_name']
+        except (KeyError, TypeError):
+            author = None
+        posts.append((text or '', text is not None, author))
+    return {
+        'screen_name': info.get('profile', {}).get('screen_name'),
+        'follows': [follower['name'] for follower in info.get('followers', [])],
+        'posts': posts,
+        'num_tweets': len(tweets)
+    }
+
+
+def iter_profile_files(user_dir: os.PathLike, skip_prefix: str = None):
+    for entry in sorted(os.listdir(user_dir)):
+        abs_path = os.path.join(user_dir, entry)
+        if entry.endswith('.json') and os.path.isfile(abs_path) and not (skip_prefix and entry.startswith(skip_prefix)):
+            yield entry[:-5], abs_path
+
+
+def source_files(source_dirs):
+    # (source, name, path) of every profile file; data_dir is source 0, data_dir/followers source 1
+    files = []
+    for source, source_dir in enumerate(source_dirs):
+        skip_prefix = 'followers' if source == 0 else None
+        files += [(source, name, path) for name, path in iter_profile_files(source_dir, skip_prefix)]
+    return files
+
+
+def compile_snapshot(data_dir: os.PathLike, output_dir: os.PathLike = None, workers: int = None):
+    # data_dir holds the target users, data_dir/followers the crawled follower profiles
+    output_dir = output_dir or os.path.join(data_dir, 'snapshot')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    source_dirs = [os.path.abspath(data_dir)]
+    followers_dir = os.path.join(data_dir, 'followers')
+    if os.path.isdir(followers_dir):
+        source_dirs.append(os.path.abspath(followers_dir))
+    files = source_files(source_dirs)
+    # stat before parsing, a file rewritten meanwhile looks newer than the snapshot and is re-read
+    mtimes = [os.stat(path).st_mtime_ns for _, _, path in files]
+
+    name_ids = {}
+
+    def intern(name):
+        if name is None:
+            return -1
+        name_id = name_ids.get(name)
+        if name_id is None:
+            name_id = name_ids[name] = len(name_ids)
+        return name_id
+
+    # everything is written under temp names and swapped in at the end, readers that already
+    # mapped the previous files keep their (unlinked) copies instead of seeing them truncated
+    def tmp_path(file_name):
+        return os.path.join(output_dir, file_name + '.tmp')
+
+    profile_names, profile_screen_names, profile_tweets = [], [], []
+    follow_offsets, follow_ids = [0], []
+    post_offsets, post_authors, post_valid = [0], [], []
+    text_offsets = [0]
+    text_size = 0
+    with open(tmp_path(TEXT_FILE), 'wb') as text_file:
+        projected = iter_projected([path for _, _, path in files], project_snapshot_profile, workers)
+        for (_, name, _), profile in zip(files, projected):
+            profile_names.append(intern(name))
+            profile_screen_names.append(intern(profile['screen_name']))
+            profile_tweets.append(profile['num_tweets'])
+            follow_ids.extend(intern(followed) for followed in profile['follows'])
+            follow_offsets.append(len(follow_ids))
+            for text, valid, author in profile['posts']:
+                data = text.encode('utf-8')
+                text_file.write(data)
+                text_size += len(data)
+                text_offsets.append(text_size)
+                post_authors.append(intern(author))
+                post_valid.append(valid)
+            post_offsets.append(len(post_authors))
+
+    names = list(name_ids)
+    encoded = [name.encode('utf-8') for name in names]
+    with open(tmp_path(NAMES_FILE), 'wb') as f:
+        f.write(b''.join(encoded))
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=name_offsets[1:])
+
+    arrays = {
+        NAME_OFFSETS_FILE: name_offsets,
+        PROFILE_NAMES_FILE: np.array(profile_names, dtype=np.int32),
+        PROFILE_SOURCES_FILE: np.array([source for source, _, _ in files], dtype=np.uint8),
+        PROFILE_SCREEN_NAMES_FILE: np.array(profile_screen_names, dtype=np.int32),
+        PROFILE_MTIMES_FILE: np.array(mtimes, dtype=np.int64),
+        PROFILE_TWEETS_FILE: np.array(profile_tweets, dtype=np.int64),
+        FOLLOW_OFFSETS_FILE: np.array(follow_offsets, dtype=np.int64),
+        FOLLOW_IDS_FILE: np.array(follow_ids, dtype=np.int32),
+        POST_OFFSETS_FILE: np.array(post_offsets, dtype=np.int64),
+        TEXT_OFFSETS_FILE: np.array(text_offsets, dtype=np.int64),
+        POST_AUTHORS_FILE: np.array(post_authors, dtype=np.int32),
+        POST_VALID_FILE: np.array(post_valid, dtype=np.bool_),
+    }
+    for file_name, array in arrays.items():
+        with open(tmp_path(file_name), 'wb') as f:
+            np.save(f, array)
+    with open(tmp_path(META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({
+            "source_dirs": source_dirs,
+            "num_profiles": len(files),
+            "num_names": len(names),
+            "num_follows": len(follow_ids),
+            "num_posts": len(post_authors)
+        }, f, ensure_ascii=False)
+
+    # readers only trust a snapshot whose meta file exists: drop it first, put the new one in last
+    if os.path.exists(os.path.join(output_dir, META_FILE)):
+        os.remove(os.path.join(output_dir, META_FILE))
+    for file_name in [TEXT_FILE, NAMES_FILE, *arrays, META_FILE]:
+        os.replace(tmp_path(file_name), os.path.join(output_dir, file_name))
+
+    print(f"[!] compiled {len(files)} profiles / {len(names)} names / {len(follow_ids)} follows / {len(post_authors)} posts into {output_dir}")
+
+
+def is_current(snapshot_dir: os.PathLike):
+    # the raw files still are exactly the ones compiled, with the same mtimes
+    snapshot = open_snapshot(snapshot_dir)
+    source_dirs = snapshot.meta['source_dirs']
+    if not all(os.path.isdir(source_dir) for source_dir in source_dirs):
+        return False
+    if len(source_dirs) == 1 and os.path.isdir(os.path.join(source_dirs[0], 'followers')):
+        return False
+    recorded = {
+        (int(source), snapshot.profile_name(profile)): int(mtime)
+        for profile, (source, mtime) in enumerate(zip(snapshot.profile_sources, snapshot.profile_mtimes))
+    }
+    current = {(source, name): os.stat(path).st_mtime_ns for source, name, path in source_files(source_dirs)}
+    return recorded == current
+
+
+def has_snapshot(snapshot_dir: os.PathLike, check_sources: bool = True):
+    if snapshot_dir is None or not os.path.exists(os.path.join(snapshot_dir, META_FILE)):
+        return False
+    return not check_sources or is_current(snapshot_dir)
+
+
+def current_snapshot(snapshot_dir: os.PathLike):
+    # snapshot_dir if it can be read instead of the raw json, otherwise None (callers fall back to json)
+    if snapshot_dir is None:
+        return None
+    if not has_snapshot(snapshot_dir, check_sources=False):
+        print(f"[!] no snapshot in {snapshot_dir}, reading json files")
+        return None
+    if not is_current(snapshot_dir):
+        print(f"[!] snapshot in {snapshot_dir} is out of date (raw files changed since it was compiled), reading json files; rerun snapshot.py")
+        return None
+    return snapshot_dir
+
+
+class Snapshot:
+    def __init__(self, snapshot_dir: os.PathLike):
+        self.snapshot_dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        def load(file_name):
+            return np.load(os.path.join(snapshot_dir, file_name), mmap_mode='r')
+
+        self.name_offsets = load(NAME_OFFSETS_FILE)
+        self.profile_names = load(PROFILE_NAMES_FILE)
+        self.profile_sources = load(PROFILE_SOURCES_FILE)
+        self.profile_screen_names = load(PROFILE_SCREEN_NAMES_FILE)
+        self.profile_mtimes = load(PROFILE_MTIMES_FILE)
+        self.profile_tweets = load(PROFILE_TWEETS_FILE)
+        self.follow_offsets = load(FOLLOW_OFFSETS_FILE)
+        self.follow_ids = load(FOLLOW_IDS_FILE)
+        self.post_offsets = load(POST_OFFSETS_FILE)
+        self.text_offsets = load(TEXT_OFFSETS_FILE)
+        self.post_authors = load(POST_AUTHORS_FILE)
+        self.post_valid = load(POST_VALID_FILE)
+        self.name_blob = self._map_bytes(NAMES_FILE)
+        self.text_blob = self._map_bytes(TEXT_FILE)
+
+        self._names = None
+
+    def _map_bytes(self, file_name):
+        path = os.path.join(self.snapshot_dir, file_name)
+        # np.memmap refuses empty files
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.profile_names)
+
+    @property
+    def names(self):
+        if self._names is None:
+            offsets = self.name_offsets.tolist()
+            blob = self.name_blob.tobytes()
+            self._names = [blob[start: end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+        return self._names
+
+    def name(self, name_id):
+        return self.names[name_id] if name_id >= 0 else None
+
+    def profiles_in(self, user_dir: os.PathLike):
+        # profile rows that were compiled from user_dir
+        source_dirs = [os.path.realpath(source_dir) for source_dir in self.meta['source_dirs']]
+        user_dir = os.path.realpath(user_dir)
+        if user_dir not in source_dirs:
+            raise ValueError(f"{self.snapshot_dir} was not compiled from {user_dir}")
+        return np.flatnonzero(self.profile_sources == source_dirs.index(user_dir))
+
+    def profile_name(self, profile):
+        return self.names[self.profile_names[profile]]
+
+    def screen_name(self, profile):
+        return self.name(self.profile_screen_names[profile])
+
+    def follows(self, profile):
+        names = self.names
+        return [names[name_id] for name_id in self.follow_ids[self.follow_offsets[profile]: self.follow_offsets[profile + 1]]]
+
+    def _post_rows(self, profile):
+        return range(self.post_offsets[profile], self.post_offsets[profile + 1])
+
+    def _text(self, row):
+        return self.text_blob[self.text_offsets[row]: self.text_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def posts(self, profile):
+        # same list server.extract_user_posts builds: unusable records become ''
+        return [self._text(row) for row in self._post_rows(profile)]
+
+    def post_authors_of(self, profile):
+        return [self.name(name_id) for name_id in self.post_authors[self.post_offsets[profile]: self.post_offsets[profile + 1]]]
+
+    def feature_text(self, profile):
+        # same text preprocess.load_single_feature_text joins, with its invalid / total counts;
+        # unusable records are stored as '' so the whole text range of the profile is the feature
+        rows = self._post_rows(profile)
+        valid = self.post_valid[rows.start: rows.stop]
+        text = self.text_blob[self.text_offsets[rows.start]: self.text_offsets[rows.stop]].tobytes().decode('utf-8')
+        return text, int(len(valid) - valid.sum()), int(self.profile_tweets[profile])
+
+
+_snapshots = {}
+
+
+def open_snapshot(snapshot_dir: os.PathLike):
+    # one mapping per directory, reopened when the snapshot is recompiled
+    mtime = os.stat(os.path.join(snapshot_dir, META_FILE)).st_mtime_ns
+    cached = _snapshots.get(snapshot_dir)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Snapshot(snapshot_dir))
+        _snapshots[snapshot_dir] = cached
+    return cached[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, required=True, help='target user files, follower profiles in <data-dir>/followers')
+    parser.add_argument('--output-dir', type=str, default=None, help='defaults to <data-dir>/snapshot')
+    parser.add_argument('--workers', type=int, default=None, help='processes parsing json files')
+    args = parser.parse_args()
+
+    compile_snapshot(args.data_dir, args.output_dir, args.workers)
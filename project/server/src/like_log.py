@@ -0,0 +1,153 @@
+import os
+import json
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # 没有 fcntl 的平台只有进程内的锁，多进程部署时压缩可能丢失其他进程刚追加的记录
+    fcntl = None
+
+
+class LikeLog:
+    # 点赞记录：新点赞按行追加到 liked_users.jsonl，liked_users.json 是压缩后的快照；
+    # 内存中维护按用户名去重、保持首次点赞顺序的视图，读取不再访问文件
+    def __init__(self, like_file: os.PathLike, fsync_interval: float = 1.0, compact_every: int = 1000):
+        self.like_file = like_file
+        self.log_file = os.path.splitext(like_file)[0] + '.jsonl'
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self._lock = threading.Lock()
+        self._fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._fsync_timer = None
+        self._reload()
+
+    def _reload(self):
+        self.profile = {"screen_name": "test"}
+        self.followers = []
+        self._names = set()
+        self._snapshot_stat = None
+        if os.path.exists(self.like_file):
+            with open(self.like_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.profile = data.get('profile', self.profile)
+            self._merge(data.get('followers', []))
+            stat = os.stat(self.like_file)
+            self._snapshot_stat = (stat.st_ino, stat.st_mtime_ns)
+        self._offset = 0
+        self._log_lines = 0
+        self._catch_up()
+
+    def _merge(self, users):
+        added = []
+        for user in users:
+            if user['name'] not in self._names:
+                self._names.add(user['name'])
+                self.followers.append(user)
+                added.append(user)
+        return added
+
+    def _catch_up(self):
+        # 读入其他进程追加的记录；快照被替换或日志被截断（另一个进程做了压缩）时整体重读
+        snapshot_stat = None
+        if os.path.exists(self.like_file):
+            stat = os.stat(self.like_file)
+            snapshot_stat = (stat.st_ino, stat.st_mtime_ns)
+        log_size = os.path.getsize(self.log_file)
+        if snapshot_stat != self._snapshot_stat or log_size < self._offset:
+            return self._reload()
+        if log_size == self._offset:
+            return
+        with open(self.log_file, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read(log_size - self._offset)
+        # 只处理完整的行，写了一半的行留到下次
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            self._merge([json.loads(line)])
+            self._log_lines += 1
+        self._offset += end
+
+    def _lock_file(self, exclusive=False):
+        # 读取取共享锁；追加与压缩取排他锁，保证 catch_up 之后到 write 之间没有其他进程写入，
+        # 本进程的记录一定落在 self._offset 处
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _schedule_fsync(self):
+        # 同一时间窗口内的点赞合并成一次 fsync
+        if self._fsync_timer is None:
+            self._fsync_timer = threading.Timer(self.fsync_interval, self.flush)
+            self._fsync_timer.daemon = True
+            self._fsync_timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._fsync_timer = None
+            os.fsync(self._fd)
+
+    def append(self, users):
+        # 只追加本次新出现的用户，一次 write 写完，返回新增的用户
+        with self._lock:
+            self._lock_file(exclusive=True)
+            try:
+                self._catch_up()
+                added = self._merge(users)
+                if added:
+                    data = ''.join(json.dumps(user, ensure_ascii=False) + '\n' for user in added).encode('utf-8')
+                    os.write(self._fd, data)
+                    self._offset += len(data)
+                    self._log_lines += len(added)
+            finally:
+                self._unlock_file()
+            if added:
+                self._schedule_fsync()
+            if self._log_lines >= self.compact_every:
+                self._compact()
+        return added
+
+    def _compact(self):
+        # 把当前视图写成快照再清空日志；排他锁保证这期间没有其他进程追加
+        self._lock_file(exclusive=True)
+        try:
+            self._catch_up()
+            tmp_file = self.like_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"profile": self.profile, "followers": self.followers}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.like_file)
+            os.ftruncate(self._fd, 0)
+            os.fsync(self._fd)
+            stat = os.stat(self.like_file)
+            self._snapshot_stat = (stat.st_ino, stat.st_mtime_ns)
+            self._offset = 0
+            self._log_lines = 0
+        finally:
+            self._unlock_file()
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _synced(self):
+        self._lock_file()
+        try:
+            self._catch_up()
+        finally:
+            self._unlock_file()
+
+    def snapshot(self):
+        with self._lock:
+            self._synced()
+            return {"profile": self.profile, "followers": list(self.followers)}
+
+    def names(self):
+        with self._lock:
+            self._synced()
+            return [user['name'] for user in self.followers]
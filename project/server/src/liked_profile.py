@@ -0,0 +1,107 @@
+import os
+import zipfile
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from ContentBased.content_based_matching import get_user_embeddings
+from ContentBased.embed_store import chunk_index_mtime
+
+
+class LikedProfile:
+    # 点赞用户的偏好向量：维护未归一化的向量和与计数，新点赞只做 O(d) 的增量更新，
+    # 点赞名单取自 LikeLog 的内存视图；状态与点赞文件放在一起，重启后只需补算状态之后新增的点赞
+    def __init__(self, like_log, vector_dir: os.PathLike):
+        self.like_log = like_log
+        self.state_file = os.path.splitext(like_log.like_file)[0] + '.pref.npz'
+        self.vector_dir = vector_dir
+        self.followers = []
+        self.embed_sum = None
+        self.count = 0
+        self._included = set()
+        self._consumed = 0
+        self._index_mtime = None
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self.embed_sum = None
+        self.count = 0
+        self._included = set()
+        self._consumed = 0
+
+    def _load_state(self, index_mtime):
+        if not os.path.exists(self.state_file):
+            return False
+        # 状态文件损坏或缺字段时当作没有状态，全量重算后会被覆盖
+        try:
+            with np.load(self.state_file) as state:
+                # consumed 按去重后的点赞名单计数，旧格式的状态按含重复的文件计数，不能沿用
+                if 'deduped' not in state.files or int(state['index_mtime_ns']) != index_mtime or int(state['consumed']) > len(self.followers):
+                    return False
+                embed_sum = state['embed_sum'] if state['count'] > 0 else None
+                count = int(state['count'])
+                consumed = int(state['consumed'])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return False
+        self.embed_sum = embed_sum
+        self.count = count
+        self._consumed = consumed
+        return True
+
+    def _save_state(self):
+        # 向量库还没有索引时没有可对应的 mtime，不保存状态
+        if self._index_mtime is None:
+            return
+        # 多个 worker 共用同一个点赞文件，临时文件按进程区分，避免互相覆盖写了一半的文件
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_file,
+            embed_sum=self.embed_sum if self.embed_sum is not None else np.zeros(0, dtype=np.float32),
+            count=self.count,
+            consumed=self._consumed,
+            index_mtime_ns=self._index_mtime,
+            deduped=True
+        )
+        os.replace(tmp_file, self.state_file)
+
+    def _apply(self, new_followers):
+        pending = [user for user in dict.fromkeys(new_followers) if user not in self._included]
+        found, embeds = get_user_embeddings(pending, self.vector_dir)
+        if found:
+            delta = embeds.sum(dim=0).numpy()
+            self.embed_sum = delta if self.embed_sum is None else self.embed_sum + delta
+            self.count += len(found)
+            self._included.update(found)
+
+    def _sync(self):
+        # 点赞名单只会在末尾增长，只需补算新增部分；向量库变了需要全量重算
+        index_mtime = chunk_index_mtime(self.vector_dir)
+        self.followers = self.like_log.names()
+        if index_mtime != self._index_mtime or self._consumed > len(self.followers):
+            first_sync = self._index_mtime is None
+            self._reset()
+            if first_sync and self._load_state(index_mtime):
+                self._included = set(self.followers[:self._consumed])
+        self._index_mtime = index_mtime
+
+        if self._consumed < len(self.followers):
+            self._apply(self.followers[self._consumed:])
+            self._consumed = len(self.followers)
+            self._save_state()
+
+    def get_followers(self):
+        with self._lock:
+            self._sync()
+            return list(self.followers)
+
+    def refresh(self):
+        # 点赞写入日志后立即做增量更新，不必等到下一次推荐请求
+        with self._lock:
+            self._sync()
+
+    def preference_embedding(self):
+        with self._lock:
+            self._sync()
+            if self.embed_sum is None:
+                return None
+            return F.normalize(torch.from_numpy(self.embed_sum).unsqueeze(0), p=2, dim=1)
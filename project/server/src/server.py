@@ -1,123 +1,193 @@
 import os
-import re
 import json
 from flask import Flask, request, jsonify
 import random
+import threading
+import time
+import hashlib
+from collections import OrderedDict
 from flask_cors import CORS
-from ContentBased.content_based_matching import get_user_preference_embedding,cosine_similarity_matching
-import torch
-
-def load_user_info(user_dir: os.PathLike):
-    user_files = {}
-    for entry in os.listdir(user_dir):
-        abs_path = os.path.join(user_dir, entry)
-        if os.path.isfile(abs_path) and abs_path.endswith('.json'):
-            user_name = entry.split('.')[0]
-            user_files[user_name] = abs_path
-    
-    user_info = {}
-    for user_name, user_file in user_files.items():
-        with open(user_file, 'r+', encoding='utf-8') as f:
-            info = json.load(f)
-            user_info[user_name] = info
-    
-    return user_info
-
-
-def load_user_feature_text(user_dir: os.PathLike):
-    user_info = load_user_info(user_dir)
-    
-    feature_dict = {}
+from ContentBased.content_based_matching import get_user_preference_embedding,top_k
+from ContentBased.embed_store import chunk_index_mtime
+from ContentBased.json_loader import extract_tweet_text, load_json
+from ContentBased.snapshot import has_snapshot, open_snapshot
+from like_log import LikeLog
+from liked_profile import LikedProfile
+
+def extract_user_posts(info):
+    posts = []
     invalid_counter = 0
-    total_counter = 0
-    for user, info in user_info.items():
-        feature_dict[user] = []
-        total_counter += len(info['tweets'])
-        for item in info['tweets']:
-            if item is None:
+    for item in info['tweets']:
+        if item is None:
+            continue
+        profile_text = extract_tweet_text(item)
+        if profile_text is None:
+            invalid_counter += 1
+            profile_text = ''
+        posts.append(profile_text)
+    return posts, invalid_counter
+
+
+class PostStore:
+    # 常驻内存的用户帖子库：只保存每个用户抽取出的帖子文本，按文件 mtime 增量刷新
+    def __init__(self, user_dir: os.PathLike, refresh_interval: float = 5.0, snapshot_dir: os.PathLike = None):
+        self.user_dir = user_dir
+        self.snapshot_dir = snapshot_dir
+        self.refresh_interval = refresh_interval
+        self._posts = {}
+        self._mtimes = {}
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _seed_from_snapshot(self):
+        # 启动时先从编译好的快照（内存映射）载入帖子，之后只重新解析 mtime 比快照新的文件
+        snapshot = open_snapshot(self.snapshot_dir)
+        try:
+            profiles = snapshot.profiles_in(self.user_dir)
+        except ValueError as e:
+            print(f"[!] {e}, reading json files instead")
+            return
+        for profile in profiles:
+            user_name = snapshot.profile_name(profile).split('.')[0]
+            self._posts[user_name] = snapshot.posts(profile)
+            self._mtimes[user_name] = int(snapshot.profile_mtimes[profile])
+
+    def _refresh(self):
+        if not self._mtimes and has_snapshot(self.snapshot_dir, check_sources=False):
+            self._seed_from_snapshot()
+
+        current = {}
+        for entry in os.scandir(self.user_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                current[entry.name.split('.')[0]] = (entry.path, entry.stat().st_mtime_ns)
+
+        # 在副本上更新后整体替换，读请求始终看到完整的一份数据
+        posts = {user_name: self._posts[user_name] for user_name in current if user_name in self._posts}
+        mtimes = {}
+        invalid_counter = 0
+        total_counter = 0
+        for user_name, (user_file, mtime) in current.items():
+            mtimes[user_name] = mtime
+            if self._mtimes.get(user_name) == mtime:
                 continue
-            try:
-                data = item['mblog']['page_info']
-                if data['title'] is None:
-                    data['title'] = ''
-                if data['content2'] is None:
-                    data['content2'] = ''
-                profile_text = data['title'] + data['content2']
-            except KeyError:
-                try:
-                    data = item['mblog']['text']
-                    profile_text = re.sub('\<.*?\>', '', data)
-                except KeyError:
-                    invalid_counter += 1
-                    profile_text = ''
-
-            # Build user feature text
-            feature_dict[user].append(profile_text)
-
-    print(f"[!] Invalid records in {user_dir}: {invalid_counter} / {total_counter}")
-    return feature_dict
+            info = load_json(user_file)
+            posts[user_name], invalid = extract_user_posts(info)
+            invalid_counter += invalid
+            total_counter += len(info['tweets'])
+            del info
+
+        self._posts = posts
+        self._mtimes = mtimes
+        if total_counter:
+            print(f"[!] Invalid records in {self.user_dir}: {invalid_counter} / {total_counter}")
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._last_check >= self.refresh_interval:
+            with self._lock:
+                if now - self._last_check >= self.refresh_interval:
+                    self._refresh()
+                    self._last_check = time.monotonic()
+        return self._posts
+
+
+class PreferenceCache:
+    # 按去重后的点赞列表缓存偏好向量及其 top-k 结果（LRU），保存点赞时整体失效
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(followers, vector_dir: os.PathLike):
+        digest = hashlib.sha1('\n'.join(sorted(set(followers))).encode('utf-8')).hexdigest()
+        # 向量库重建后旧的结果不再可用
+        index_mtime = chunk_index_mtime(vector_dir)
+        return digest, vector_dir, index_mtime
+
+    def _entry(self, followers, vector_dir: os.PathLike, compute=None):
+        key = self.make_key(followers, vector_dir)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        if compute is not None:
+            embed = compute()
+        else:
+            embed = get_user_preference_embedding(sorted(set(followers)), vector_dir)
+        entry = {"embed": embed, "top": {}}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def preference_embedding(self, followers, vector_dir: os.PathLike, compute=None):
+        return self._entry(followers, vector_dir, compute)["embed"]
+
+    def top_k(self, followers, vector_dir: os.PathLike, k: int, compute=None):
+        entry = self._entry(followers, vector_dir, compute)
+        result = entry["top"].get(k)
+        if result is None:
+            if entry["embed"] is None:
+                return {"users": [], "sims": []}
+            result = top_k(entry["embed"], vector_dir, k)
+            entry["top"][k] = result
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 app = Flask(__name__)
 CORS(app)
 
 sims = {"users": [], "sims": []}
+post_store = PostStore("data/followers", snapshot_dir="data/snapshot")
+preference_cache = PreferenceCache()
+like_log = LikeLog('liked_users.json')
+liked_profile = LikedProfile(like_log, 'src/embeds/vectorized')
 
-# 路由：接收前端发送的被点赞用户信息，并将其添加到 JSON 文件中
+# 路由：接收前端发送的被点赞用户信息，追加到点赞日志中
 @app.route('/api/save_liked_users', methods=['POST'])
 def save_liked_users():
     data = request.get_json()
     liked_users = data.get('followers', [])
 
-    # 读取 JSON 文件
-    filename = 'liked_users.json'
-    if os.path.exists(filename):
-        with open(filename, 'r', encoding='utf-8') as file:  # 修改这里的编码为 UTF-8
-            liked_data = json.load(file)
-    else:
-        liked_data = {"profile": {"screen_name": "test"}, "followers": []}
-
-    # 将新的被点赞用户信息添加到 followers 列表中
-    for user in liked_users:
-        liked_data['followers'].append(user)
+    # 只追加新出现的用户，已点赞过的用户不重复记录
+    added = like_log.append(liked_users)
 
-    # 将更新后的数据写入 JSON 文件
-    with open(filename, 'w', encoding='utf-8') as file:  # 修改这里的编码为 UTF-8
-        json.dump(liked_data, file, ensure_ascii=False)
+    # 增量更新偏好向量（O(d)）
+    if added:
+        liked_profile.refresh()
+        preference_cache.clear()
 
     return jsonify({'message': 'Liked users saved successfully'})
 
 
 @app.route('/api/recommend_users', methods=['GET'])
 def recommend_users():
-    feature_dict = load_user_feature_text("data/followers")
+    feature_dict = post_store.get()
 
-    user_file = 'liked_users.json'
     vectorized_follower_dir = 'src/embeds/vectorized'
     num_recommend = 10
     topn = 10
     
     # 读取用户信息
-    with open(user_file, 'r', encoding='utf-8') as f:
-        info = json.load(f)
-        followers = [follower['name'] for follower in info['followers']]
+    followers = liked_profile.get_followers()
         
     # 获取用户偏好推荐
-    pref_embed = get_user_preference_embedding(followers, vectorized_follower_dir)
-    sims = cosine_similarity_matching(pref_embed, vectorized_follower_dir)
+    sims = preference_cache.top_k(followers, vectorized_follower_dir, topn, liked_profile.preference_embedding)
 
     # 构建推荐列表，一半偏好推送，一半随机推送
     recommend_posts = []
     
     #偏好推送
-    recommend_users = []
-    rank = torch.argsort(torch.tensor(sims['sims']), descending=True).numpy().tolist()
-    counter = 0
-
-    for i, index in enumerate(rank):
-        recommend_users.append(sims['users'][index])
-        counter += 1
-        if counter >= topn:
-            break
+    recommend_users = sims['users']
     recommend_users = random.sample(recommend_users,min(len(recommend_users),num_recommend//2))
 
     for user in recommend_users:
@@ -143,14 +213,8 @@ def recommend_users():
 # 路由：获取点赞用户数据
 @app.route('/api/liked_users', methods=['GET'])
 def get_liked_users():
-    try:
-        # 读取点赞用户数据
-        with open('liked_users.json', 'r', encoding='utf-8') as file:
-            liked_users_data = json.load(file)
-            return jsonify(liked_users_data)
-    except FileNotFoundError:
-        # 如果文件不存在，返回空列表
-        return jsonify({'followers': []})
+    # 直接返回内存中的去重视图，不再读文件
+    return jsonify(like_log.snapshot())
     
 # 路由：获取推荐用户的分数
 @app.route('/api/similarity_scores', methods=['GET'])
@@ -158,24 +222,14 @@ def get_recommend_user_score():
     try:
         recommend_users_list=[]
         # 获取用户偏好推荐
-        user_file = 'liked_users.json'
         vectorized_follower_dir = 'src/embeds/vectorized'
 
         # 读取用户信息
-        with open(user_file, 'r', encoding='utf-8') as f:
-            info = json.load(f)
-            followers = [follower['name'] for follower in info['followers']]
-
-        pref_embed = get_user_preference_embedding(followers, vectorized_follower_dir)
-        sims = cosine_similarity_matching(pref_embed, vectorized_follower_dir)
-        rank = torch.argsort(torch.tensor(sims['sims']), descending=True).numpy().tolist()
-        counter = 0
-        print(sims)
-        for i, index in enumerate(rank):
-            recommend_users_list.append({"user": sims['users'][index],"sims":round(sims['sims'][index], 4)})
-            counter += 1
-            if counter >= 10:
-                break
+        followers = liked_profile.get_followers()
+
+        sims = preference_cache.top_k(followers, vectorized_follower_dir, 10, liked_profile.preference_embedding)
+        for user, sim in zip(sims['users'], sims['sims']):
+            recommend_users_list.append({"user": user,"sims":round(sim, 4)})
         return jsonify(recommend_users_list)
     except len(sims)==0:
         return jsonify({"user":[],"sims":[]})
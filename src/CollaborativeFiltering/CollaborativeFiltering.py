@@ -1,32 +1,58 @@
 import os
+import sys
 import json
+import math
+import heapq
+import itertools
 import numpy as np
 import random
 
-def load_data(base_path):
-    user_data = {}
-    
-    # 读取所有用户名命名的json文件
-    for user_file in os.listdir(base_path):
-        if user_file.endswith(".json") and not user_file.startswith("followers"):
-            with open(os.path.join(base_path, user_file), 'r') as file:
-                data = json.load(file)
-                user_data[user_file[:-5]] = data  
-    
+# 与 ContentBased 共用的并行 json 加载器
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ContentBased'))
+from json_loader import load_projected_dir, project_follow_profile, project_screen_name
+from snapshot import current_snapshot, has_snapshot, open_snapshot
+from parallel_cf import format_recommendations, run_parallel
+from postings import FollowPostings
+from sparse_cf import SparseCF
+
+def load_data(base_path, workers=None, snapshot_dir=None):
+    # 有编译好的快照（见 ContentBased/snapshot.py）且原始文件没有变化时直接从内存映射读取，不再解析 json
+    snapshot_dir = current_snapshot(snapshot_dir)
+    if snapshot_dir is not None:
+        return load_snapshot_data(base_path, snapshot_dir)
+
+    # 进程池并行解析，只保留协同过滤用到的字段（关注列表、推文作者），不再常驻整份原始 json
+    user_data = load_projected_dir(base_path, project_follow_profile, workers, skip_prefix="followers")
+
     # 读取followers数据
     followers_path = os.path.join(base_path, 'followers')
     followers_data = {}
     if os.path.exists(followers_path):
-        for follower_file in os.listdir(followers_path):
-            if follower_file.endswith(".json"):
-                with open(os.path.join(followers_path, follower_file), 'r') as file:
-                    data = json.load(file)
-                    followers_data[follower_file[:-5]] = data  
+        followers_data = load_projected_dir(followers_path, project_screen_name, workers)
 
     return user_data, followers_data
 
 
-def create_user_follow_matrix(user_data, followers_data):
+def load_snapshot_data(base_path, snapshot_dir):
+    # 构造与 load_data 相同结构的数据
+    snapshot = open_snapshot(snapshot_dir)
+    user_data = {}
+    for profile in snapshot.profiles_in(base_path):
+        user_data[snapshot.profile_name(profile)] = {
+            'followers': [{'name': name} for name in snapshot.follows(profile)],
+            'tweets': [{'mblog': {'user': {'screen_name': author}}} for author in snapshot.post_authors_of(profile) if author is not None]
+        }
+
+    followers_path = os.path.join(base_path, 'followers')
+    followers_data = {}
+    if os.path.exists(followers_path):
+        for profile in snapshot.profiles_in(followers_path):
+            followers_data[snapshot.profile_name(profile)] = {'profile': {'screen_name': snapshot.screen_name(profile)}}
+
+    return user_data, followers_data
+
+
+def create_user_follow_matrix(user_data, followers_data, postings_dir=None):
     user_follow_matrix = {}
     all_followed = set()
 
@@ -38,6 +64,10 @@ def create_user_follow_matrix(user_data, followers_data):
         user_follow_matrix[user] = valid_follows
         all_followed.update(valid_follows)
 
+    # 同时保存倒排表（被关注账号 → 有序的用户编号），见 postings.py
+    if postings_dir is not None:
+        FollowPostings.build(user_follow_matrix).save(postings_dir)
+
     return user_follow_matrix, all_followed
 
 
@@ -75,40 +105,95 @@ def pearson_correlation(user1, user2, user_follow_matrix):
     return numerator / denominator if denominator != 0 else 0
 
 
-def recommend_tweets(user, user_follow_matrix, all_users, user_data, num_recommendations=5):
-    # 计算相似度并保留相关系数
-    similarities = {other: pearson_correlation(user, other, user_follow_matrix) for other in all_users if other != user}
-    sorted_similarities = sorted(similarities.items(), key=lambda x: x[1], reverse=True)
-
-    recommendations = set()
-    correlations = {}
-    for similar_user, similarity in sorted_similarities:
-        if len(recommendations) >= num_recommendations:
+class NeighbourIndex:
+    # 基于倒排表（见 postings.py），只为与目标用户有共同关注的用户计算相似度
+    def __init__(self, user_follow_matrix, all_users, postings=None):
+        self.all_users = list(all_users)
+        self.positions = {user: i for i, user in enumerate(self.all_users)}
+        self.counts = [len(user_follow_matrix.get(user, ())) for user in self.all_users]
+        self.follows = user_follow_matrix
+        # 保存的倒排表用户顺序不同时重新构建
+        if postings is None or postings.users != self.all_users:
+            postings = FollowPostings.build(user_follow_matrix, self.all_users)
+        self.postings = postings
+        # 没有关注任何账号的用户，与任何人的相关系数都是 0
+        self.empty_users = [i for i, count in enumerate(self.counts) if count == 0]
+
+    def co_counts(self, user):
+        others, counts = self.postings.co_follow_counts(self.follows.get(user, ()))
+        return dict(zip(others.tolist(), counts.tolist()))
+
+    def top_k(self, user, k):
+        # 与 sorted(pearson_correlation ..., reverse=True) 相同的前 k 名（同分按 all_users 顺序），
+        # 用大小为 k 的最小堆；堆元素 (相似度, -顺序)，越大越靠前
+        me = self.positions[user]
+        a = self.counts[me]
+        if a == 0:
+            others = (i for i in range(len(self.all_users)) if i != me)
+            return [(self.all_users[i], 0) for i in itertools.islice(others, k)]
+
+        heap = []
+
+        def push(similarity, other):
+            entry = (similarity, -other)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+        common = self.co_counts(user)
+        common.pop(me, None)
+        for other, c in common.items():
+            # 0/1 向量在两人关注并集上的 Pearson：-sqrt((a-c)(b-c) / (a*b))
+            b = self.counts[other]
+            push(-math.sqrt((a - c) * (b - c) / (a * b)) + 0.0, other)
+        # 同分时顺序靠前者优先，空关注用户只有前 k 个可能进堆
+        pushed = 0
+        for other in self.empty_users:
+            if pushed >= k:
+                break
+            if other != me:
+                push(0.0, other)
+                pushed += 1
+
+        neighbours = [(self.all_users[-order], similarity) for similarity, order in sorted(heap, reverse=True)]
+        # 没有共同关注的非空用户相关系数恒为 -1，是最低分，只在候选不足 k 个时按顺序补齐
+        if len(neighbours) < k:
+            for other in range(len(self.all_users)):
+                if len(neighbours) >= k:
+                    break
+                if other != me and other not in common and self.counts[other] > 0:
+                    neighbours.append((self.all_users[other], -1.0))
+        return neighbours
+
+
+def recommend_tweets(user, user_follow_matrix, all_users, user_data, num_recommendations=5, neighbour_index=None):
+    # 只取前 k 个最相似的用户；推荐数不够时把 k 扩大后重取
+    if neighbour_index is None:
+        neighbour_index = NeighbourIndex(user_follow_matrix, all_users)
+    k = max(4 * num_recommendations, 32)
+    while True:
+        neighbours = neighbour_index.top_k(user, k)
+        recommendations = {}
+        correlations = {}
+        for similar_user, similarity in neighbours:
+            if len(recommendations) >= num_recommendations:
+                break
+            correlations[similar_user] = similarity
+            if 'tweets' in user_data[similar_user]:
+                for tweet in user_data[similar_user]['tweets']:
+                    if 'mblog' in tweet and 'user' in tweet['mblog'] and 'screen_name' in tweet['mblog']['user']:
+                        screen_name = tweet['mblog']['user']['screen_name']
+                        recommendations[screen_name] = None
+        if len(recommendations) >= num_recommendations or len(neighbours) < k:
             break
-        correlations[similar_user] = similarity
-        if 'tweets' in user_data[similar_user]:
-            for tweet in user_data[similar_user]['tweets']:
-                if 'mblog' in tweet and 'user' in tweet['mblog'] and 'screen_name' in tweet['mblog']['user']:
-                    screen_name = tweet['mblog']['user']['screen_name']
-                    recommendations.add(screen_name)
+        k *= 4
     return list(recommendations)[:num_recommendations], correlations
 
 def format_and_save_recommendations(user_recommendations, filename="recommendations.txt"):
     with open(filename, "w", encoding="utf-8") as file:
-        for user, data in user_recommendations.items():
-            recommendations, correlations = data
-            
-            rec_with_scores = [(rec, correlations.get(rec, float('-inf'))) for rec in recommendations]
-            
-            rec_with_scores.sort(key=lambda x: x[1], reverse=True)
-            
-            file.write(f"[!] target user: {user}\n")
-            file.write("Preference ranking:\n")
-            for idx, (rec, score) in enumerate(rec_with_scores, start=1):
-                
-                score_display = 'N/A' if score == float('-inf') else f"{score:.6f}"
-                file.write(f"{idx}. {rec} : {score_display}\n")
-            file.write("\n")
+        for user, (recommendations, correlations) in user_recommendations.items():
+            file.write(format_recommendations(user, recommendations, correlations))
 
 
 
@@ -119,11 +204,13 @@ def format_and_save_recommendations(user_recommendations, filename="recommendati
 if __name__ == "__main__":
     base_path = "/Users/zhangyunhe/Files/homework/数据挖掘/BIT-DataMining/data"
 
+    snapshot_dir = os.path.join(base_path, 'snapshot')
+
     print("[!] load user data")
-    user_data, followers_data = load_data(base_path)
+    user_data, followers_data = load_data(base_path, snapshot_dir=snapshot_dir if has_snapshot(snapshot_dir, check_sources=False) else None)
 
-    # 获取用户-关注矩阵和所有用户列表
-    user_follow_matrix, all_followed = create_user_follow_matrix(user_data, followers_data)
+    # 获取用户-关注矩阵和所有用户列表，倒排表保存到 follow_postings
+    user_follow_matrix, all_followed = create_user_follow_matrix(user_data, followers_data, postings_dir='follow_postings')
     all_users = list(user_follow_matrix.keys())
 
     # for user, data in user_data.items():
@@ -135,11 +222,9 @@ if __name__ == "__main__":
     #     print(f"{user}: {list(follows)}\n")
 
     print("[!] test")
-    tweet_recommendations = {}
-    for user in all_users:
-        recommendations, correlations = recommend_tweets(user, user_follow_matrix, all_users, user_data, num_recommendations=10)
-        tweet_recommendations[user] = (recommendations, correlations)
-
-    format_and_save_recommendations(tweet_recommendations)
+    # 稀疏矩阵计算相似度，结果与逐对调用 recommend_tweets 一致；
+    # 用户分片到进程池，完成一片写一片，中断后重新运行会从 recommendations.txt 已写完的用户之后继续
+    engine = SparseCF(user_follow_matrix, all_users)
+    run_parallel(engine, user_data, "recommendations.txt", num_recommendations=10)
     
     
\ No newline at end of file
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 快照读取与 ContentBased 共用
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ContentBased'))
+from snapshot import has_snapshot
+from sparse_cf import SparseCF, recommend_all
+from CollaborativeFiltering import load_data, create_user_follow_matrix, pearson_correlation, format_and_save_recommendations
+
+
+USER_FACTORS_FILE = 'user_factors.npy'
+ITEM_FACTORS_FILE = 'item_factors.npy'
+USERS_FILE = 'users.txt'
+ITEMS_FILE = 'items.txt'
+META_FILE = 'als_meta.json'
+
+# 一个求解块内补齐后的 (用户, 关注) 槽位数与用户数上限，控制块内临时张量的大小
+BLOCK_SLOTS = 1 << 15
+BLOCK_ROWS = 1024
+
+
+def solve_rows(matrix, fixed, gram, regularization, alpha, out, rows):
+    # 隐式反馈 ALS（Hu et al. 2008）：0/1 关注矩阵，置信度 c = 1 + alpha
+    # x_u = (YᵀY + alpha·Σ y_i y_iᵀ + λI)⁻¹ (1 + alpha)·Σ y_i，i 为 u 关注的账号
+    sub = matrix[rows]
+    counts = np.diff(sub.indptr)
+    factors = fixed.shape[1]
+
+    A = np.broadcast_to(gram + regularization * np.eye(factors), (len(rows), factors, factors)).copy()
+    b = np.zeros((len(rows), factors))
+    max_count = int(counts.max()) if len(counts) else 0
+    if max_count > 0:
+        # 每个用户的关注向量补零成 (max_count, factors)，Σ y_i y_iᵀ 变成一次批量矩阵乘
+        padded = np.zeros((len(rows), max_count, factors))
+        row_of = np.repeat(np.arange(len(rows)), counts)
+        slot = np.arange(len(sub.indices)) - np.repeat(sub.indptr[:-1], counts)
+        padded[row_of, slot] = fixed[sub.indices]
+        A += alpha * (padded.transpose(0, 2, 1) @ padded)
+        b = (1 + alpha) * padded.sum(axis=1)
+    out[rows] = np.linalg.solve(A, b[..., None])[..., 0]
+
+
+def row_blocks(matrix, block_slots=BLOCK_SLOTS, block_rows=BLOCK_ROWS):
+    # 按关注数排序后切块，块内关注数相近，补零浪费少
+    counts = np.diff(matrix.indptr)
+    order = np.argsort(counts, kind='stable')
+    block = []
+    for row, count in zip(order.tolist(), counts[order].tolist()):
+        if block and ((len(block) + 1) * count > block_slots or len(block) >= block_rows):
+            yield np.array(block)
+            block = []
+        block.append(row)
+    if block:
+        yield np.array(block)
+
+
+def solve_side(executor, matrix, fixed, regularization, alpha):
+    out = np.empty((matrix.shape[0], fixed.shape[1]))
+    gram = fixed.T @ fixed
+    futures = [
+        executor.submit(solve_rows, matrix, fixed, gram, regularization, alpha, out, rows)
+        for rows in row_blocks(matrix)
+    ]
+    for future in futures:
+        future.result()
+    return out
+
+
+class ALSModel:
+    # 用户与被关注账号的稠密隐因子，一个用户的打分只需一次矩阵-向量乘
+    def __init__(self, users, items, user_factors, item_factors):
+        self.users = list(users)
+        self.user_ids = {user: i for i, user in enumerate(self.users)}
+        self.items = list(items)
+        self.item_ids = {item: i for i, item in enumerate(self.items)}
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+
+    def scores(self, user):
+        return np.asarray(self.item_factors, dtype=np.float32) @ np.asarray(self.user_factors[self.user_ids[user]], dtype=np.float32)
+
+    def recommend(self, user, follows=(), num_recommendations=5):
+        scores = self.scores(user)
+        # 已关注的账号不再推荐
+        followed = [self.item_ids[item] for item in follows if item in self.item_ids]
+        scores[followed] = -np.inf
+        k = min(num_recommendations, len(scores) - len(set(followed)))
+        if k <= 0:
+            return [], {}
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        recommendations = [self.items[j] for j in top]
+        return recommendations, {item: float(scores[j]) for item, j in zip(recommendations, top)}
+
+    def save(self, output_dir):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # 普通 .npy，加载时可以直接内存映射
+        np.save(os.path.join(output_dir, USER_FACTORS_FILE), np.asarray(self.user_factors, dtype=np.float32))
+        np.save(os.path.join(output_dir, ITEM_FACTORS_FILE), np.asarray(self.item_factors, dtype=np.float32))
+        with open(os.path.join(output_dir, USERS_FILE), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.users))
+        with open(os.path.join(output_dir, ITEMS_FILE), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.items))
+        with open(os.path.join(output_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"num_users": len(self.users), "num_items": len(self.items), "factors": int(self.user_factors.shape[1])}, f)
+
+    @classmethod
+    def load(cls, model_dir):
+        with open(os.path.join(model_dir, USERS_FILE), 'r', encoding='utf-8') as f:
+            users = f.read().split('\n') if os.path.getsize(os.path.join(model_dir, USERS_FILE)) else []
+        with open(os.path.join(model_dir, ITEMS_FILE), 'r', encoding='utf-8') as f:
+            items = f.read().split('\n') if os.path.getsize(os.path.join(model_dir, ITEMS_FILE)) else []
+        return cls(
+            users,
+            items,
+            np.load(os.path.join(model_dir, USER_FACTORS_FILE), mmap_mode='r'),
+            np.load(os.path.join(model_dir, ITEM_FACTORS_FILE), mmap_mode='r')
+        )
+
+
+def train_als(engine: SparseCF, factors=64, iterations=15, regularization=0.1, alpha=40.0, num_threads=None, seed=0, verbose=True):
+    user_items = engine.matrix.tocsr()
+    item_users = engine.matrix.T.tocsr()
+    rng = np.random.default_rng(seed)
+    user_factors = rng.normal(0, 0.01, (user_items.shape[0], factors))
+    item_factors = rng.normal(0, 0.01, (user_items.shape[1], factors))
+
+    # 批量矩阵乘和 LAPACK 求解都会释放 GIL，线程池即可并行
+    with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count() or 1) as executor:
+        for iteration in range(iterations):
+            start = time.perf_counter()
+            user_factors = solve_side(executor, user_items, item_factors, regularization, alpha)
+            item_factors = solve_side(executor, item_users, user_factors, regularization, alpha)
+            if verbose:
+                print(f"[!] ALS iteration {iteration + 1}/{iterations}: {time.perf_counter() - start:.2f}s")
+
+    return ALSModel(engine.users, engine.items, user_factors.astype(np.float32), item_factors.astype(np.float32))
+
+
+def benchmark(model, engine, user_follow_matrix, user_data, num_users=100, num_recommendations=10, seed=0):
+    # 三条路径各推荐 num_users 个用户，比较吞吐（用户/秒）
+    users = random.Random(seed).sample(engine.users, min(num_users, len(engine.users)))
+    all_users = engine.users
+
+    # 原始逐对 Pearson，只计算相似度，不含取推文
+    pair_users = users[:max(1, min(len(users), 10))]
+    start = time.perf_counter()
+    for user in pair_users:
+        sorted({other: pearson_correlation(user, other, user_follow_matrix) for other in all_users if other != user}.items(), key=lambda x: x[1], reverse=True)
+    pairwise = len(pair_users) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    recommend_all(engine, user_data, num_recommendations, users=users)
+    blocked = len(users) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for user in users:
+        model.recommend(user, user_follow_matrix.get(user, ()), num_recommendations)
+    als = len(users) / (time.perf_counter() - start)
+
+    print(f"[!] {len(all_users)} users / {len(engine.items)} followed accounts")
+    print(f"pairwise pearson : {pairwise:10.2f} users/sec ({len(pair_users)} users)")
+    print(f"sparse pearson   : {blocked:10.2f} users/sec")
+    print(f"als              : {als:10.2f} users/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, required=True)
+    parser.add_argument('--model-dir', type=str, default='als_factors')
+    parser.add_argument('--factors', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=15)
+    parser.add_argument('--regularization', type=float, default=0.1)
+    parser.add_argument('--alpha', type=float, default=40.0, help='confidence of an observed follow is 1 + alpha')
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--num-recommend', type=int, default=10)
+    parser.add_argument('--output', type=str, default='recommendations_als.txt')
+    parser.add_argument('--skip-train', action='store_true', help='reuse the saved factors')
+    parser.add_argument('--benchmark-users', type=int, default=0, help='compare throughput with the pearson paths on this many users')
+    args = parser.parse_args()
+
+    snapshot_dir = os.path.join(args.data_dir, 'snapshot')
+
+    print("[!] load user data")
+    user_data, followers_data = load_data(args.data_dir, snapshot_dir=snapshot_dir if has_snapshot(snapshot_dir, check_sources=False) else None)
+    user_follow_matrix, all_followed = create_user_follow_matrix(user_data, followers_data)
+    engine = SparseCF(user_follow_matrix)
+
+    if args.skip_train:
+        model = ALSModel.load(args.model_dir)
+    else:
+        model = train_als(engine, args.factors, args.iterations, args.regularization, args.alpha, args.num_threads)
+        model.save(args.model_dir)
+        model = ALSModel.load(args.model_dir)
+
+    recommendations = {user: model.recommend(user, user_follow_matrix[user], args.num_recommend) for user in model.users}
+    format_and_save_recommendations(recommendations, args.output)
+
+    if args.benchmark_users > 0:
+        benchmark(model, engine, user_follow_matrix, user_data, args.benchmark_users, args.num_recommend)
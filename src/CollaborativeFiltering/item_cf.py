@@ -0,0 +1,153 @@
+import os
+import sys
+import argparse
+import numpy as np
+
+
+# 快照读取与 ContentBased 共用
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ContentBased'))
+from snapshot import has_snapshot
+from sparse_cf import BLOCK_ELEMENTS, SparseCF
+from CollaborativeFiltering import load_data, create_user_follow_matrix, format_and_save_recommendations
+
+
+NEIGHBOURS_FILE = 'item_neighbours.npz'
+
+
+def item_similarity_block(item_matrix, counts, rows, metric='cosine'):
+    # 被关注账号×用户的 CSR 矩阵，rows 与所有账号的共同关注人数，再按 metric 归一化
+    common = (item_matrix @ item_matrix[rows].toarray().T).T
+    a = counts[rows][:, None]
+    b = counts[None, :]
+    if metric == 'count':
+        sims = common
+    elif metric == 'cosine':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = common / np.sqrt(a * b)
+    elif metric == 'jaccard':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = common / (a + b - common)
+    else:
+        raise ValueError(f"unknown similarity metric: {metric}")
+    # 没有共同关注者的账号不算邻居
+    sims[common == 0] = -np.inf
+    return sims
+
+
+class ItemNeighbours:
+    # 每个被关注账号的 top-K 共同关注邻居，按 CSR 存放：neighbours[offsets[i]: offsets[i + 1]]
+    def __init__(self, items, offsets, neighbours, scores, metric='cosine'):
+        self.items = list(items)
+        self.item_ids = {item: i for i, item in enumerate(self.items)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.neighbours = np.asarray(neighbours, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.metric = metric
+
+    @classmethod
+    def build(cls, engine: SparseCF, k=50, metric='cosine', block_size=None):
+        item_matrix = engine.matrix.T.tocsr()
+        counts = np.diff(item_matrix.indptr).astype(np.float64)
+        num_items = item_matrix.shape[0]
+        k = min(k, max(num_items - 1, 0))
+        block_size = block_size or max(1, BLOCK_ELEMENTS // max(num_items, 1))
+
+        offsets = [0]
+        neighbours = []
+        scores = []
+        for start in range(0, num_items if k > 0 else 0, block_size):
+            rows = np.arange(start, min(start + block_size, num_items))
+            sims = item_similarity_block(item_matrix, counts, rows, metric)
+            sims[np.arange(len(rows)), rows] = -np.inf
+            for row_sims in sims:
+                # 第 k 名的分数之上（含并列）全部取出，再按分数降序、账号编号升序截断，结果与分块无关
+                kth = row_sims[np.argpartition(-row_sims, k - 1)[k - 1]] if k < num_items else -np.inf
+                top = np.flatnonzero((row_sims >= kth) & np.isfinite(row_sims))
+                top = top[np.lexsort((top, -row_sims[top]))][:k]
+                neighbours.append(top)
+                scores.append(row_sims[top])
+                offsets.append(offsets[-1] + len(top))
+        if k == 0:
+            offsets = [0] * (num_items + 1)
+
+        return cls(
+            engine.items,
+            offsets,
+            np.concatenate(neighbours) if neighbours else np.zeros(0, dtype=np.int32),
+            np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32),
+            metric
+        )
+
+    def save(self, path):
+        np.savez(
+            path,
+            items=np.array(self.items, dtype=str),
+            offsets=self.offsets,
+            neighbours=self.neighbours,
+            scores=self.scores,
+            metric=np.array(self.metric)
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['items'].tolist(), data['offsets'], data['neighbours'], data['scores'], str(data['metric']))
+
+    def neighbours_of(self, item):
+        i = self.item_ids[item]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [(self.items[j], float(s)) for j, s in zip(self.neighbours[start: end], self.scores[start: end])]
+
+    def recommend(self, follows, num_recommendations=5):
+        # 合并用户所有关注账号的邻居列表，按相似度之和排序，开销只与关注数×K 有关
+        followed = np.array(sorted({self.item_ids[item] for item in follows if item in self.item_ids}), dtype=np.int64)
+        if len(followed) == 0:
+            return [], {}
+        segments = [np.arange(self.offsets[i], self.offsets[i + 1]) for i in followed]
+        positions = np.concatenate(segments)
+        candidates, inverse = np.unique(self.neighbours[positions], return_inverse=True)
+        totals = np.bincount(inverse, weights=self.scores[positions].astype(np.float64), minlength=len(candidates))
+
+        # 已关注的账号不再推荐
+        keep = ~np.isin(candidates, followed)
+        candidates = candidates[keep]
+        totals = totals[keep]
+        order = np.lexsort((candidates, -totals))[:num_recommendations]
+
+        recommendations = [self.items[j] for j in candidates[order]]
+        scores = {item: float(total) for item, total in zip(recommendations, totals[order])}
+        return recommendations, scores
+
+
+def recommend_all_items(item_neighbours, user_follow_matrix, num_recommendations=5, users=None):
+    users = user_follow_matrix.keys() if users is None else users
+    return {user: item_neighbours.recommend(user_follow_matrix[user], num_recommendations) for user in users}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, required=True)
+    parser.add_argument('--neighbours-file', type=str, default=NEIGHBOURS_FILE)
+    parser.add_argument('--num-neighbours', type=int, default=50)
+    parser.add_argument('--metric', type=str, default='cosine', choices=['cosine', 'jaccard', 'count'])
+    parser.add_argument('--num-recommend', type=int, default=10)
+    parser.add_argument('--output', type=str, default='recommendations_item.txt')
+    parser.add_argument('--skip-build', action='store_true', help='reuse the saved neighbours file')
+    args = parser.parse_args()
+
+    snapshot_dir = os.path.join(args.data_dir, 'snapshot')
+
+    print("[!] load user data")
+    user_data, followers_data = load_data(args.data_dir, snapshot_dir=snapshot_dir if has_snapshot(snapshot_dir, check_sources=False) else None)
+    user_follow_matrix, all_followed = create_user_follow_matrix(user_data, followers_data)
+
+    if args.skip_build:
+        item_neighbours = ItemNeighbours.load(args.neighbours_file)
+    else:
+        # 离线：一次算出每个被关注账号的 top-K 邻居并保存
+        item_neighbours = ItemNeighbours.build(SparseCF(user_follow_matrix), args.num_neighbours, args.metric)
+        item_neighbours.save(args.neighbours_file)
+        print(f"[!] saved top-{args.num_neighbours} neighbours of {len(item_neighbours.items)} followed accounts to {args.neighbours_file}")
+
+    recommendations = recommend_all_items(item_neighbours, user_follow_matrix, args.num_recommend)
+    format_and_save_recommendations(recommendations, args.output)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sparse_cf import SparseCF, collect_screen_names, recommend_all
+
+
+TARGET_PREFIX = "[!] target user: "
+
+# 子进程共享的只读数据：fork 时直接继承父进程内存（写时复制），spawn 时由 initargs 序列化传入
+_engine = None
+_screen_names = None
+
+
+def format_recommendations(user, recommendations, correlations):
+    # recommendations.txt 中一个用户的完整记录，以空行结尾
+    rec_with_scores = [(rec, correlations.get(rec, float('-inf'))) for rec in recommendations]
+    rec_with_scores.sort(key=lambda x: x[1], reverse=True)
+
+    lines = [f"{TARGET_PREFIX}{user}", "Preference ranking:"]
+    for idx, (rec, score) in enumerate(rec_with_scores, start=1):
+        score_display = 'N/A' if score == float('-inf') else f"{score:.6f}"
+        lines.append(f"{idx}. {rec} : {score_display}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def completed_users(output_file):
+    # 读取已有输出中完整写完的用户；崩溃时写了一半的尾部记录被截掉，之后从这里继续追加
+    done = set()
+    if not os.path.exists(output_file):
+        return done
+    with open(output_file, 'rb') as f:
+        data = f.read()
+
+    end = 0
+    start = 0
+    while True:
+        block_end = data.find(b'\n\n', start)
+        if block_end < 0:
+            break
+        block = data[start: block_end].decode('utf-8', errors='replace')
+        if block.startswith(TARGET_PREFIX):
+            done.add(block.split('\n', 1)[0][len(TARGET_PREFIX):])
+        start = end = block_end + 2
+
+    if end < len(data):
+        with open(output_file, 'r+b') as f:
+            f.truncate(end)
+    return done
+
+
+def _init_worker(engine, screen_names):
+    global _engine, _screen_names
+    _engine = engine
+    _screen_names = screen_names
+
+
+def _recommend_shard(users, num_recommendations, metric):
+    result = recommend_all(_engine, None, num_recommendations, metric, users=users, screen_names=_screen_names)
+    return len(users), ''.join(format_recommendations(user, *result[user]) for user in users)
+
+
+def run_parallel(engine: SparseCF, user_data, output_file, num_recommendations=5, metric='pearson', workers=None, shard_size=256, resume=True):
+    # 用户分片交给进程池，每片完成即追加写入并落盘；resume 时跳过输出文件中已经完成的用户
+    if not resume and os.path.exists(output_file):
+        os.remove(output_file)
+    done = completed_users(output_file)
+    pending = [user for user in engine.users if user not in done]
+    print(f"[!] {len(done)} users already in {output_file}, {len(pending)} to go")
+    if not pending:
+        return
+
+    screen_names = collect_screen_names(user_data)
+    shards = [pending[i: i + shard_size] for i in range(0, len(pending), shard_size)]
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+    start = time.perf_counter()
+    finished = 0
+    with open(output_file, 'a', encoding='utf-8') as out, ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(engine, screen_names)) as executor:
+        futures = [executor.submit(_recommend_shard, shard, num_recommendations, metric) for shard in shards]
+        for future in as_completed(futures):
+            count, text = future.result()
+            out.write(text)
+            out.flush()
+            os.fsync(out.fileno())
+            finished += count
+            elapsed = time.perf_counter() - start
+            print(f"[!] {finished}/{len(pending)} users, {finished / elapsed:.1f} users/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, required=True)
+    parser.add_argument('--output', type=str, default='recommendations.txt')
+    parser.add_argument('--num-recommend', type=int, default=10)
+    parser.add_argument('--metric', type=str, default='pearson', choices=['pearson', 'cosine', 'jaccard'])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=256)
+    parser.add_argument('--restart', action='store_true', help='discard the existing output instead of resuming it')
+    args = parser.parse_args()
+
+    # 快照读取与 ContentBased 共用
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ContentBased'))
+    from snapshot import has_snapshot
+    from CollaborativeFiltering import load_data, create_user_follow_matrix
+
+    snapshot_dir = os.path.join(args.data_dir, 'snapshot')
+
+    print("[!] load user data")
+    user_data, followers_data = load_data(args.data_dir, snapshot_dir=snapshot_dir if has_snapshot(snapshot_dir, check_sources=False) else None)
+    user_follow_matrix, all_followed = create_user_follow_matrix(user_data, followers_data)
+
+    engine = SparseCF(user_follow_matrix, list(user_follow_matrix.keys()))
+    run_parallel(engine, user_data, args.output, args.num_recommend, args.metric, args.workers, args.shard_size, resume=not args.restart)
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+
+
+USERS_FILE = 'users.txt'
+ITEMS_FILE = 'items.txt'
+OFFSETS_FILE = 'offsets.npy'
+USER_IDS_FILE = 'user_ids.npy'
+
+
+def intersect(a, b):
+    # 两个有序、无重复的用户编号数组求交
+    return np.intersect1d(a, b, assume_unique=True)
+
+
+def intersect_many(arrays):
+    # 从最短的开始求交，结果为空时提前结束
+    arrays = sorted(arrays, key=len)
+    if not arrays:
+        return np.zeros(0, dtype=np.int32)
+    result = arrays[0]
+    for array in arrays[1:]:
+        if len(result) == 0:
+            break
+        result = intersect(result, array)
+    return result
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = f.read()
+    return data.split('\n') if data else []
+
+
+def _write_lines(path, lines):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+
+class FollowPostings:
+    # 倒排表：被关注账号 j 的关注者是 user_ids[offsets[j]: offsets[j + 1]]，按用户编号升序
+    def __init__(self, users, items, offsets, user_ids):
+        self.users = list(users)
+        self.items = list(items)
+        self.item_ids = {item: j for j, item in enumerate(self.items)}
+        self.offsets = offsets
+        self.user_ids = user_ids
+
+    @classmethod
+    def build(cls, user_follow_matrix, all_users=None):
+        users = list(all_users) if all_users is not None else list(user_follow_matrix.keys())
+        items = sorted(set().union(*user_follow_matrix.values())) if user_follow_matrix else []
+        item_ids = {item: j for j, item in enumerate(items)}
+
+        # 按 (账号, 用户) 排序即得到每个账号有序的关注者列表
+        pairs = [(item_ids[item], i) for i, user in enumerate(users) for item in user_follow_matrix.get(user, ())]
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=len(items)), out=offsets[1:])
+        return cls(users, items, offsets, pairs[:, 1].astype(np.int32))
+
+    def save(self, output_dir):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        np.save(os.path.join(output_dir, OFFSETS_FILE), np.asarray(self.offsets, dtype=np.int64))
+        np.save(os.path.join(output_dir, USER_IDS_FILE), np.asarray(self.user_ids, dtype=np.int32))
+        _write_lines(os.path.join(output_dir, USERS_FILE), self.users)
+        _write_lines(os.path.join(output_dir, ITEMS_FILE), self.items)
+
+    @classmethod
+    def load(cls, postings_dir):
+        # 数组按内存映射打开
+        return cls(
+            _read_lines(os.path.join(postings_dir, USERS_FILE)),
+            _read_lines(os.path.join(postings_dir, ITEMS_FILE)),
+            np.load(os.path.join(postings_dir, OFFSETS_FILE), mmap_mode='r'),
+            np.load(os.path.join(postings_dir, USER_IDS_FILE), mmap_mode='r')
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    def followers_of(self, item):
+        j = self.item_ids.get(item)
+        if j is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.user_ids[self.offsets[j]: self.offsets[j + 1]]
+
+    def follower_count(self, item):
+        j = self.item_ids.get(item)
+        return 0 if j is None else int(self.offsets[j + 1] - self.offsets[j])
+
+    def common_followers(self, items):
+        # 同时关注 items 中所有账号的用户
+        return intersect_many([self.followers_of(item) for item in items])
+
+    def co_follow_count(self, item_a, item_b):
+        return len(intersect(self.followers_of(item_a), self.followers_of(item_b)))
+
+    def overlap_similarity(self, item_a, item_b, metric='jaccard'):
+        # 两个账号关注者集合的重合度
+        common = self.co_follow_count(item_a, item_b)
+        a = self.follower_count(item_a)
+        b = self.follower_count(item_b)
+        if common == 0:
+            return 0.0
+        if metric == 'jaccard':
+            return common / (a + b - common)
+        if metric == 'cosine':
+            return float(common / np.sqrt(a * b))
+        raise ValueError(f"unknown similarity metric: {metric}")
+
+    def co_follow_counts(self, items):
+        # 候选生成：与关注列表 items 至少有一个共同关注的用户，及各自的共同关注数
+        arrays = [self.followers_of(item) for item in items]
+        if not arrays:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(arrays), return_counts=True)
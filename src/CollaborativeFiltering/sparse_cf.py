@@ -0,0 +1,177 @@
+import argparse
+import numpy as np
+from scipy import sparse
+
+
+# 每个块的稠密相似度矩阵大约占用的元素个数（float64，约 32MB）
+BLOCK_ELEMENTS = 1 << 22
+
+
+class SparseCF:
+    # 用户×被关注账号的 0/1 CSR 矩阵，一次构建，所有相似度都由稀疏矩阵乘积得到
+    def __init__(self, user_follow_matrix, all_users=None):
+        self.users = list(all_users) if all_users is not None else list(user_follow_matrix.keys())
+        self.user_ids = {user: i for i, user in enumerate(self.users)}
+
+        items = sorted(set().union(*user_follow_matrix.values())) if user_follow_matrix else []
+        self.items = items
+        self.item_ids = {item: i for i, item in enumerate(items)}
+
+        indptr = [0]
+        indices = []
+        for user in self.users:
+            indices.extend(sorted(self.item_ids[item] for item in user_follow_matrix.get(user, ())))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float64)
+        self.matrix = sparse.csr_matrix(
+            (data, np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(self.users), len(items))
+        )
+        self.counts = np.diff(self.matrix.indptr).astype(np.float64)
+
+    def co_counts(self, rows):
+        # 稀疏×稠密，直接得到稠密的共同关注数块 (len(rows), N)
+        return (self.matrix @ self.matrix[rows].toarray().T).T
+
+    def similarity_block(self, rows, metric='pearson'):
+        rows = np.asarray(rows)
+        common = self.co_counts(rows)
+        a = self.counts[rows][:, None]
+        b = self.counts[None, :]
+        with np.errstate(divide='ignore'):
+            inv_a = np.where(a > 0, 1.0 / a, 0.0)
+            inv_b = np.where(b > 0, 1.0 / b, 0.0)
+
+        if metric == 'pearson':
+            # 与 pearson_correlation 一致：只在两人关注集合的并集 n = a + b - c 上计算。
+            # 并集上的 0/1 向量有 n-a = b-c、n-b = a-c，于是
+            # r = (n*c - a*b) / sqrt(a(n-a) * b(n-b)) = -sqrt((a-c)(b-c) / (a*b))
+            sims = a - common
+            np.subtract(b, common, out=common)
+            sims *= common
+            sims *= inv_a
+            sims *= inv_b
+            np.sqrt(sims, out=sims)
+            np.negative(sims, out=sims)
+            # -0.0 → 0.0，与 pearson_correlation 返回的 0 输出一致
+            sims += 0.0
+        elif metric == 'cosine':
+            sims = common
+            sims *= np.sqrt(inv_a)
+            sims *= np.sqrt(inv_b)
+        elif metric == 'jaccard':
+            union = a + b - common
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sims = np.where(union > 0, common / union, 0.0)
+        else:
+            raise ValueError(f"unknown similarity metric: {metric}")
+        return sims
+
+    def similarity_matrix(self, metric='pearson'):
+        return self.similarity_block(np.arange(len(self.users)), metric)
+
+    def iter_similarity_blocks(self, metric='pearson', rows=None, block_size=None):
+        num_users = len(self.users)
+        rows = np.arange(num_users) if rows is None else np.asarray(rows)
+        block_size = block_size or max(1, BLOCK_ELEMENTS // max(num_users, 1))
+        for start in range(0, len(rows), block_size):
+            block_rows = rows[start: start + block_size]
+            yield block_rows, self.similarity_block(block_rows, metric)
+
+
+def ranked_neighbours(sims_row, self_row, prefetch):
+    # 与 sorted(..., reverse=True) 相同的稳定降序（同分按用户顺序），先只排前 prefetch 名；
+    # 与第 prefetch 名同分的用户全部放进头部，否则 argpartition 会随意丢掉其中编号靠前的
+    sims_row = sims_row.copy()
+    sims_row[self_row] = -np.inf
+    num_candidates = len(sims_row) - 1
+    seen = set()
+    if prefetch < num_candidates:
+        kth = sims_row[np.argpartition(-sims_row, prefetch - 1)[prefetch - 1]]
+        head = np.flatnonzero(sims_row >= kth)
+        head = head[np.lexsort((head, -sims_row[head]))]
+        seen.update(head.tolist())
+        yield from head
+    for other in np.argsort(-sims_row, kind='stable')[:num_candidates]:
+        if other not in seen:
+            yield other
+
+
+def collect_screen_names(user_data):
+    screen_names = {}
+    for user, data in user_data.items():
+        names = {}
+        for tweet in data.get('tweets', []):
+            if tweet and 'mblog' in tweet and 'user' in tweet['mblog'] and 'screen_name' in tweet['mblog']['user']:
+                names[tweet['mblog']['user']['screen_name']] = None
+        screen_names[user] = list(names)
+    return screen_names
+
+
+def recommend_all(engine, user_data, num_recommendations=5, metric='pearson', users=None, screen_names=None):
+    # 分片多次调用时可以传入已经收集好的 screen_names
+    if screen_names is None:
+        screen_names = collect_screen_names(user_data)
+    rows = None if users is None else [engine.user_ids[user] for user in users]
+    prefetch = max(4 * num_recommendations, 32)
+
+    tweet_recommendations = {}
+    for block_rows, block in engine.iter_similarity_blocks(metric, rows):
+        for row, sims_row in zip(block_rows, block):
+            recommendations = {}
+            correlations = {}
+            for other in ranked_neighbours(sims_row, row, prefetch):
+                if len(recommendations) >= num_recommendations:
+                    break
+                similar_user = engine.users[other]
+                correlations[similar_user] = float(sims_row[other])
+                for name in screen_names.get(similar_user, ()):
+                    recommendations[name] = None
+            tweet_recommendations[engine.users[row]] = (list(recommendations)[:num_recommendations], correlations)
+    return tweet_recommendations
+
+
+def check_against_pairwise(num_users=300, num_items=8, num_recommendations=10, seed=0):
+    # 回归检查：在大量同分的随机 0/1 数据上，recommend_all 的邻居顺序、相关系数和推荐结果
+    # 与逐对 pearson_correlation + 稳定降序（recommend_tweets 的语义）一致。
+    # 逐对求和有末位误差、recommend_tweets 从 set 截断顺序不定，参照结果把相关系数保留 9 位小数后再排序
+    from CollaborativeFiltering import pearson_correlation
+
+    rng = np.random.default_rng(seed)
+    user_follow_matrix = {f"u{u}": {f"i{i}" for i in rng.choice(num_items, rng.integers(0, num_items // 2 + 1), replace=False)} for u in range(num_users)}
+    user_data = {user: {'tweets': [{'mblog': {'user': {'screen_name': f"s{rng.integers(0, 50)}"}}} for _ in range(rng.integers(0, 3))]} for user in user_follow_matrix}
+    all_users = list(user_follow_matrix)
+
+    result = recommend_all(SparseCF(user_follow_matrix, all_users), user_data, num_recommendations)
+    screen_names = collect_screen_names(user_data)
+    mismatches = 0
+    for user in all_users:
+        similarities = {other: round(float(pearson_correlation(user, other, user_follow_matrix)), 9) for other in all_users if other != user}
+        recommendations = {}
+        correlations = {}
+        for similar_user, similarity in sorted(similarities.items(), key=lambda x: x[1], reverse=True):
+            if len(recommendations) >= num_recommendations:
+                break
+            correlations[similar_user] = similarity
+            for name in screen_names[similar_user]:
+                recommendations[name] = None
+
+        got_recommendations, got_correlations = result[user]
+        if (got_recommendations != list(recommendations)[:num_recommendations]
+                or list(got_correlations) != list(correlations)
+                or any(abs(got_correlations[other] - correlations[other]) > 1e-9 for other in correlations)):
+            mismatches += 1
+    print(f"[!] {mismatches} / {num_users} users differ from the pairwise pearson reference")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-users', type=int, default=300)
+    parser.add_argument('--num-items', type=int, default=8)
+    parser.add_argument('--num-recommend', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if check_against_pairwise(args.num_users, args.num_items, args.num_recommend, args.seed):
+        raise SystemExit(1)
@@ -0,0 +1,427 @@
+import os
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+import torch
+
+
+EMBEDS_FILE = 'embeds.npy'
+USERS_FILE = 'users.txt'
+META_FILE = 'store_meta.json'
+# per-row scales of an int8 store: row ≈ codes * scale
+SCALES_FILE = 'scales.npy'
+
+# rows are upcast block by block when the stored dtype is not float32
+SCORE_BLOCK_ROWS = 65536
+# compressed rows are decoded into a reused float32 buffer small enough to stay in cache
+COMPRESSED_BLOCK_ROWS = 256
+
+
+# user -> chunk id index of a vectorized directory: a compact binary snapshot plus an
+# append-only log of the chunks written (and users removed) since the last compaction
+INDEX_FILE = 'index.npz'
+INDEX_LOG_FILE = 'index.wal'
+LEGACY_INDEX_FILE = 'index.json'
+
+
+def _read_compact_index(vector_dir: os.PathLike):
+    index_file = os.path.join(vector_dir, INDEX_FILE)
+    if os.path.exists(index_file):
+        with np.load(index_file) as data:
+            users = data['users'].tobytes().decode('utf-8')
+            return dict(zip(users.split('\n') if users else [], data['chunks'].tolist()))
+    legacy_file = os.path.join(vector_dir, LEGACY_INDEX_FILE)
+    if os.path.exists(legacy_file):
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def _replay_index_log(vector_dir: os.PathLike, user_index):
+    # returns the byte length of the complete records; a torn last line (crash mid-append) is ignored
+    log_file = os.path.join(vector_dir, INDEX_LOG_FILE)
+    if not os.path.exists(log_file):
+        return 0
+    with open(log_file, 'rb') as f:
+        data = f.read()
+    valid = 0
+    for line in data.split(b'\n')[:-1]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        if 'removed' in record:
+            for user in record['removed']:
+                user_index.pop(user, None)
+        else:
+            for user in record['users']:
+                user_index[user] = record['chunk']
+        valid += len(line) + 1
+    return valid
+
+
+def load_chunk_index(vector_dir: os.PathLike):
+    user_index = _read_compact_index(vector_dir)
+    _replay_index_log(vector_dir, user_index)
+    return user_index
+
+
+def chunk_index_mtime(vector_dir: os.PathLike):
+    # newest modification time (ns) of the index files, None when nothing is vectorized yet
+    mtimes = [
+        os.stat(path).st_mtime_ns
+        for path in (os.path.join(vector_dir, name) for name in (INDEX_FILE, INDEX_LOG_FILE, LEGACY_INDEX_FILE))
+        if os.path.exists(path)
+    ]
+    return max(mtimes) if mtimes else None
+
+
+class ChunkIndexWriter:
+    # owned by vectorize.py: every written chunk costs one appended (and fsynced) log line,
+    # the full index is only rewritten every compact_every records and on close
+    def __init__(self, vector_dir: os.PathLike, compact_every: int = 64):
+        self.vector_dir = vector_dir
+        self.compact_every = compact_every
+        self.index = _read_compact_index(vector_dir)
+        valid = _replay_index_log(vector_dir, self.index)
+        self.log_file = os.path.join(vector_dir, INDEX_LOG_FILE)
+        self._log = open(self.log_file, 'ab')
+        self._log.truncate(valid)
+        self._records = 0
+
+    def _append(self, record):
+        self._log.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._records += 1
+        if self._records >= self.compact_every:
+            self.compact()
+
+    def add(self, chunk_id: int, users):
+        # call after the chunk and its info file are on disk
+        users = list(users)
+        for user in users:
+            self.index[user] = chunk_id
+        self._append({"chunk": chunk_id, "users": users})
+
+    def remove(self, users):
+        users = [user for user in users if user in self.index]
+        if not users:
+            return
+        for user in users:
+            self.index.pop(user)
+        self._append({"removed": users})
+
+    def compact(self):
+        # the log is replayed over the compact index, so a crash between the two steps loses nothing
+        tmp_file = os.path.join(self.vector_dir, INDEX_FILE + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.savez(
+                f,
+                users=np.frombuffer('\n'.join(self.index).encode('utf-8'), dtype=np.uint8),
+                chunks=np.fromiter(self.index.values(), dtype=np.int32, count=len(self.index))
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, os.path.join(self.vector_dir, INDEX_FILE))
+        self._log.truncate(0)
+        self._records = 0
+        legacy_file = os.path.join(self.vector_dir, LEGACY_INDEX_FILE)
+        if os.path.exists(legacy_file):
+            os.remove(legacy_file)
+
+    def close(self):
+        self.compact()
+        self._log.close()
+
+
+def load_chunk_info(vector_dir: os.PathLike, chunk_id: int):
+    chunk_info_file = os.path.join(vector_dir, f"chunk_info_{chunk_id:>04d}.json")
+    with open(chunk_info_file, 'r+', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def live_rows(chunk_info):
+    # rows of users removed by vectorize.py --refresh-changed stay in the chunk as tombstones
+    tombstones = set(chunk_info.get('tombstones', []))
+    return [row for row in range(len(chunk_info['users'])) if row not in tombstones]
+
+
+def load_chunk_embeddings(vector_dir: os.PathLike, users):
+    # float32 embeddings of the given users straight from the chunk files, in input order
+    user_index = load_chunk_index(vector_dir)
+    chunk_users = {}
+    for user in users:
+        if user in user_index:
+            chunk_users.setdefault(user_index[user], []).append(user)
+
+    found = []
+    embeds = []
+    for chunk_id, users_in_chunk in chunk_users.items():
+        chunk_info = load_chunk_info(vector_dir, chunk_id)
+        positions = {chunk_info['users'][row]: row for row in live_rows(chunk_info)}
+        chunk_embed = torch.load(os.path.join(vector_dir, f"chunk_{chunk_id:>04d}.bin"), map_location='cpu')
+
+        users_in_chunk = [user for user in users_in_chunk if user in positions]
+        found.extend(users_in_chunk)
+        embeds.append(chunk_embed[[positions[user] for user in users_in_chunk]].float())
+    if not embeds:
+        return found, None
+    # restore input order across chunks
+    order = {user: i for i, user in enumerate(found)}
+    embeds = torch.cat(embeds, dim=0)
+    found_sorted = [user for user in users if user in order]
+    return found_sorted, embeds[[order[user] for user in found_sorted]]
+
+
+def quantize_rows(rows):
+    # symmetric per-row int8: the largest magnitude of each row maps to 127
+    scales = np.abs(rows).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def convert_chunks(vector_dir: os.PathLike, output_dir: os.PathLike = None, dtype: str = 'float32'):
+    output_dir = output_dir or vector_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    user_index = load_chunk_index(vector_dir)
+    num_chunks = max(user_index.values()) + 1 if user_index else 0
+
+    # first pass: collect row layout without keeping any embeddings around
+    chunk_rows = []
+    chunk_users = []
+    for chunk_id in range(num_chunks):
+        chunk_info = load_chunk_info(vector_dir, chunk_id)
+        rows = live_rows(chunk_info)
+        chunk_rows.append(rows)
+        chunk_users.append([chunk_info['users'][row] for row in rows])
+    num_rows = sum(len(users) for users in chunk_users)
+
+    embeds = None
+    scales = np.ones(num_rows, dtype=np.float32)
+    users = []
+    row = 0
+    for chunk_id in range(num_chunks):
+        chunk_file = os.path.join(vector_dir, f"chunk_{chunk_id:>04d}.bin")
+        chunk_embed = torch.load(chunk_file, map_location='cpu').float().numpy()[chunk_rows[chunk_id]]
+        if embeds is None:
+            # write to a temp name so readers never map a half-written matrix
+            tmp_file = os.path.join(output_dir, EMBEDS_FILE + '.tmp')
+            embeds = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=(num_rows, chunk_embed.shape[1]))
+        if dtype == 'int8':
+            embeds[row: row + len(chunk_embed)], scales[row: row + len(chunk_embed)] = quantize_rows(chunk_embed)
+        else:
+            embeds[row: row + len(chunk_embed)] = chunk_embed
+        users.extend(chunk_users[chunk_id])
+        row += len(chunk_embed)
+
+    if embeds is None:
+        raise ValueError(f"no vectorized chunks found in {vector_dir}")
+    dim = embeds.shape[1]
+    embeds.flush()
+    del embeds
+
+    users_tmp = os.path.join(output_dir, USERS_FILE + '.tmp')
+    with open(users_tmp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(users))
+    if dtype == 'int8':
+        # np.save keeps the .npy suffix, so the temp name has it too
+        scales_tmp = os.path.join(output_dir, 'tmp_' + SCALES_FILE)
+        np.save(scales_tmp, scales)
+        os.replace(scales_tmp, os.path.join(output_dir, SCALES_FILE))
+    with open(os.path.join(output_dir, META_FILE), 'w', encoding='utf-8') as f:
+        # the chunks stay the full-precision source for re-ranking
+        json.dump({"num_users": num_rows, "dim": dim, "dtype": dtype, "source_dir": os.path.abspath(vector_dir)}, f)
+    os.replace(users_tmp, os.path.join(output_dir, USERS_FILE))
+    os.replace(tmp_file, os.path.join(output_dir, EMBEDS_FILE))
+
+    print(f"[!] converted {num_chunks} chunks / {num_rows} users into {output_dir} ({dtype})")
+
+
+def has_store(store_dir: os.PathLike):
+    embeds_file = os.path.join(store_dir, EMBEDS_FILE)
+    if not os.path.exists(embeds_file):
+        return False
+    # a store older than the chunk index is stale, fall back to chunks until reconverted
+    index_mtime = chunk_index_mtime(store_dir)
+    return index_mtime is None or os.stat(embeds_file).st_mtime_ns >= index_mtime
+
+
+def select_top(sims, k):
+    # partial selection of the k best scores, sorted descending; masked (-inf) entries never come back
+    sims = np.asarray(sims)
+    k = min(k, len(sims))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-sims, k - 1)[:k] if k < len(sims) else np.arange(len(sims))
+    top = top[np.argsort(-sims[top], kind='stable')]
+    return top[np.isfinite(sims[top])]
+
+
+class EmbeddingStore:
+    def __init__(self, store_dir: os.PathLike):
+        self.store_dir = store_dir
+        self.embeds = np.load(os.path.join(store_dir, EMBEDS_FILE), mmap_mode='r')
+        with open(os.path.join(store_dir, USERS_FILE), 'r', encoding='utf-8') as f:
+            self.users = f.read().split('\n')
+        if len(self.users) != len(self.embeds):
+            raise ValueError(f"{store_dir}: {len(self.users)} users but {len(self.embeds)} embedding rows")
+        self.scales = None
+        if self.embeds.dtype == np.int8:
+            self.scales = np.load(os.path.join(store_dir, SCALES_FILE))
+            if len(self.scales) != len(self.embeds):
+                raise ValueError(f"{store_dir}: {len(self.scales)} scales but {len(self.embeds)} embedding rows")
+        meta_file = os.path.join(store_dir, META_FILE)
+        self.source_dir = store_dir
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                self.source_dir = json.load(f).get('source_dir', store_dir)
+
+        self._user_rows = None
+
+    def __len__(self):
+        return len(self.users)
+
+    @property
+    def user_rows(self):
+        if self._user_rows is None:
+            self._user_rows = {user: row for row, user in enumerate(self.users)}
+        return self._user_rows
+
+    def lookup(self, users):
+        # row of every given user, -1 for users not in the store; users.txt is the persisted row
+        # order and the name -> row dict is built once per mapping (open_store caches the store)
+        user_rows = self.user_rows
+        users = list(users)
+        return np.fromiter((user_rows.get(user, -1) for user in users), dtype=np.int64, count=len(users))
+
+    def rows_of(self, users):
+        rows = self.lookup(users)
+        return rows[rows >= 0]
+
+    def __getitem__(self, index):
+        # float32 rows (a slice or an array of row ids), int8 codes are scaled back
+        rows = np.asarray(self.embeds[index], dtype=np.float32)
+        if self.scales is not None:
+            rows *= self.scales[index][:, None]
+        return rows
+
+    def scores(self, preference_embed):
+        if isinstance(preference_embed, torch.Tensor):
+            preference_embed = preference_embed.detach().cpu().numpy()
+        query = np.asarray(preference_embed, dtype=np.float32).reshape(-1)
+
+        if self.embeds.dtype == np.float32:
+            return self.embeds @ query
+
+        # score the compressed rows: each block is decoded into the same small buffer,
+        # int8 scales are applied to the dot products instead of the rows
+        sims = np.empty(len(self.embeds), dtype=np.float32)
+        buffer = np.empty((COMPRESSED_BLOCK_ROWS, self.embeds.shape[1]), dtype=np.float32)
+        with warnings.catch_warnings():
+            # torch warns about wrapping the read-only mapping, it is only read
+            warnings.simplefilter('ignore')
+            buffer_tensor = torch.from_numpy(buffer)
+            for start in range(0, len(self.embeds), COMPRESSED_BLOCK_ROWS):
+                block = self.embeds[start: start + COMPRESSED_BLOCK_ROWS]
+                decoded = buffer[:len(block)]
+                if self.embeds.dtype == np.int8:
+                    np.copyto(decoded, block, casting='unsafe')
+                else:
+                    # numpy's float16 conversion is several times slower than torch's
+                    buffer_tensor[:len(block)].copy_(torch.from_numpy(block))
+                np.dot(decoded, query, out=sims[start: start + len(block)])
+        if self.scales is not None:
+            sims *= self.scales
+        return sims
+
+    def rerank(self, preference_embed, rows, sims):
+        # rescore candidate rows of a float16 / int8 store with the exact float32 chunk embeddings
+        if self.embeds.dtype == np.float32 or len(rows) == 0:
+            return rows, sims
+        if isinstance(preference_embed, torch.Tensor):
+            preference_embed = preference_embed.detach().cpu().numpy()
+        query = np.asarray(preference_embed, dtype=np.float32).reshape(-1)
+
+        found, exact = load_chunk_embeddings(self.source_dir, [self.users[row] for row in rows])
+        sims = np.array(sims, dtype=np.float32)
+        if exact is not None:
+            exact_sims = dict(zip(found, (exact.numpy() @ query).tolist()))
+            # users missing from the chunks (re-vectorized since conversion) keep their compressed score
+            sims = np.array([exact_sims.get(self.users[row], sim) for row, sim in zip(rows, sims)], dtype=np.float32)
+        order = select_top(sims, len(sims))
+        return rows[order], sims[order]
+
+
+_stores = {}
+
+
+def open_store(store_dir: os.PathLike):
+    # keep one mapping per directory, reopened only when the matrix file is replaced
+    embeds_file = os.path.join(store_dir, EMBEDS_FILE)
+    mtime = os.stat(embeds_file).st_mtime_ns
+    cached = _stores.get(store_dir)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, EmbeddingStore(store_dir))
+        _stores[store_dir] = cached
+    return cached[1]
+
+
+def evaluate_recall(store_dir: os.PathLike, num_queries: int = 100, k: int = 10, rerank: int = 100, seed: int = 0):
+    # recall@k of the store (and of float32 re-ranking its top `rerank`) against an exact float32 scan,
+    # on preference-like queries: normalized sums of 20 random users
+    store = open_store(store_dir)
+    found, exact = load_chunk_embeddings(store.source_dir, store.users)
+    if len(found) != len(store):
+        raise ValueError(f"{store_dir}: store no longer matches the chunks in {store.source_dir}, reconvert it")
+    exact = exact.numpy()
+
+    rng = np.random.default_rng(seed)
+    queries = np.stack([exact[rng.choice(len(exact), min(20, len(exact)), replace=False)].sum(axis=0) for _ in range(num_queries)])
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    hits = 0
+    rerank_hits = 0
+    scan_time = 0.0
+    exact_time = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        exact_sims = exact @ query
+        exact_time += time.perf_counter() - start
+        truth = set(select_top(exact_sims, k).tolist())
+
+        start = time.perf_counter()
+        sims = store.scores(query)
+        scan_time += time.perf_counter() - start
+        hits += len(truth & set(select_top(sims, k).tolist()))
+
+        candidates = select_top(sims, max(k, rerank))
+        rows, _ = store.rerank(query, candidates, sims[candidates])
+        rerank_hits += len(truth & set(rows[:k].tolist()))
+
+    footprint = store.embeds.nbytes + (store.scales.nbytes if store.scales is not None else 0)
+    print(f"[!] {len(store)} users, dim {store.embeds.shape[1]}, {store.embeds.dtype}: {footprint / 2 ** 20:.1f} MiB (float32 {exact.nbytes / 2 ** 20:.1f} MiB)")
+    print(f"recall@{k}                : {hits / (k * num_queries):.4f}")
+    print(f"recall@{k}, re-ranked top {rerank}: {rerank_hits / (k * num_queries):.4f}")
+    print(f"scan ms/query            : {scan_time / num_queries * 1000:.2f} (float32 {exact_time / num_queries * 1000:.2f})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectorized-follower-dir', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, default=None)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--evaluate', type=int, default=0, help='report recall@10 against float32 on this many queries')
+    parser.add_argument('--rerank', type=int, default=100, help='candidates rescored in float32 during --evaluate')
+    parser.add_argument('--skip-convert', action='store_true', help='evaluate the existing store')
+    args = parser.parse_args()
+
+    if not args.skip_convert:
+        convert_chunks(args.vectorized_follower_dir, args.output_dir, args.dtype)
+    if args.evaluate > 0:
+        evaluate_recall(args.output_dir or args.vectorized_follower_dir, args.evaluate, rerank=args.rerank)
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+try:
+    from .embed_store import EMBEDS_FILE, convert_chunks, has_store, open_store, select_top
+except ImportError:
+    from embed_store import EMBEDS_FILE, convert_chunks, has_store, open_store, select_top
+
+
+CODEBOOKS_FILE = 'pq_codebooks.npy'
+CODES_FILE = 'pq_codes.npy'
+META_FILE = 'pq_meta.json'
+
+NUM_CENTROIDS = 256
+ENCODE_BLOCK_ROWS = 16384
+SCAN_BLOCK_ROWS = 65536
+
+
+def _as_query(preference_embed):
+    if isinstance(preference_embed, torch.Tensor):
+        preference_embed = preference_embed.detach().cpu().numpy()
+    return np.asarray(preference_embed, dtype=np.float32).reshape(-1)
+
+
+def _nearest(sub, centroids):
+    # squared euclidean distance without the constant |x|^2 term
+    return np.argmin((centroids ** 2).sum(axis=1)[None, :] - 2 * sub @ centroids.T, axis=1)
+
+
+def train_codebooks(embeds, num_subspaces, num_iters=15, sample_size=20000, seed=0):
+    # one k-means with 256 centroids per contiguous slice of dimensions, trained on a sample of rows
+    rng = np.random.default_rng(seed)
+    dim = np.asarray(embeds[:1]).shape[1]
+    if dim % num_subspaces:
+        raise ValueError(f"embedding dim {dim} is not divisible by {num_subspaces} subspaces")
+    sample_rows = np.sort(rng.choice(len(embeds), min(sample_size, len(embeds)), replace=False))
+    sample = np.asarray(embeds[sample_rows], dtype=np.float32)
+    num_centroids = min(NUM_CENTROIDS, len(sample))
+    sub_dim = dim // num_subspaces
+
+    codebooks = np.zeros((num_subspaces, NUM_CENTROIDS, sub_dim), dtype=np.float32)
+    for m in range(num_subspaces):
+        sub = sample[:, m * sub_dim: (m + 1) * sub_dim]
+        centroids = sub[rng.choice(len(sub), num_centroids, replace=False)].copy()
+        for _ in range(num_iters):
+            labels = _nearest(sub, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sub)
+            counts = np.bincount(labels, minlength=num_centroids)
+            # empty centroids restart from random sample rows
+            empty = counts == 0
+            centroids = sums / np.maximum(counts, 1)[:, None]
+            centroids[empty] = sub[rng.choice(len(sub), int(empty.sum()), replace=False)]
+        codebooks[m, :num_centroids] = centroids
+    return codebooks
+
+
+def encode(embeds, codebooks):
+    # codes are stored subspace-major (num_subspaces, num_users): the scan reads one contiguous row per subspace
+    num_subspaces, num_centroids, sub_dim = codebooks.shape
+    codes = np.empty((num_subspaces, len(embeds)), dtype=np.uint8)
+    for start in range(0, len(embeds), ENCODE_BLOCK_ROWS):
+        block = np.asarray(embeds[start: start + ENCODE_BLOCK_ROWS], dtype=np.float32)
+        for m in range(num_subspaces):
+            codes[m, start: start + len(block)] = _nearest(block[:, m * sub_dim: (m + 1) * sub_dim], codebooks[m])
+    return codes
+
+
+def build_pq_index(vector_dir: os.PathLike, num_subspaces: int = 32, num_iters: int = 15, sample_size: int = 20000, seed: int = 0):
+    if not has_store(vector_dir):
+        convert_chunks(vector_dir)
+    store = open_store(vector_dir)
+
+    # the store decodes float16 / int8 rows to float32 on indexing
+    codebooks = train_codebooks(store, num_subspaces, num_iters=num_iters, sample_size=sample_size, seed=seed)
+    codes = encode(store, codebooks)
+
+    np.save(os.path.join(vector_dir, CODEBOOKS_FILE), codebooks)
+    np.save(os.path.join(vector_dir, CODES_FILE), codes)
+    with open(os.path.join(vector_dir, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({
+            "num_subspaces": num_subspaces,
+            "num_users": len(store),
+            "store_mtime_ns": os.stat(os.path.join(vector_dir, EMBEDS_FILE)).st_mtime_ns
+        }, f)
+    print(f"[!] built PQ index over {len(store)} users, {num_subspaces} bytes per user")
+
+
+class PQIndex:
+    def __init__(self, vector_dir: os.PathLike):
+        self.store = open_store(vector_dir)
+        self.codebooks = np.load(os.path.join(vector_dir, CODEBOOKS_FILE))
+        self.codes = np.load(os.path.join(vector_dir, CODES_FILE), mmap_mode='r')
+        self.num_subspaces, _, self.sub_dim = self.codebooks.shape
+
+    def tables(self, query):
+        # asymmetric distance: inner product of each query slice with every centroid of its subspace
+        return np.einsum('mcd,md->mc', self.codebooks, query.reshape(self.num_subspaces, self.sub_dim))
+
+    def scores(self, preference_embed):
+        tables = self.tables(_as_query(preference_embed))
+        num_users = self.codes.shape[1]
+        sims = np.empty(num_users, dtype=np.float32)
+        for start in range(0, num_users, SCAN_BLOCK_ROWS):
+            block = np.zeros(min(SCAN_BLOCK_ROWS, num_users - start), dtype=np.float32)
+            for m in range(self.num_subspaces):
+                block += tables[m].take(self.codes[m, start: start + SCAN_BLOCK_ROWS])
+            sims[start: start + len(block)] = block
+        return sims
+
+    def search(self, preference_embed, k, exclude_rows=None, rerank=None):
+        # same contract as IVFIndex.search; with rerank, the best `rerank` codes are rescored with the store rows
+        query = _as_query(preference_embed)
+        sims = self.scores(query)
+        if exclude_rows is not None and len(exclude_rows):
+            sims[exclude_rows] = -np.inf
+        rows = select_top(sims, max(k, rerank or 0))
+        if not rerank:
+            return rows[:k], sims[rows[:k]]
+        rows = np.sort(rows)
+        sims = self.store[rows] @ query
+        order = select_top(sims, k)
+        return rows[order], sims[order]
+
+
+def has_pq_index(vector_dir: os.PathLike):
+    meta_file = os.path.join(vector_dir, META_FILE)
+    if not os.path.exists(meta_file) or not has_store(vector_dir):
+        return False
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    # codes built against an older store would point at the wrong rows
+    return meta['store_mtime_ns'] == os.stat(os.path.join(vector_dir, EMBEDS_FILE)).st_mtime_ns
+
+
+_indexes = {}
+
+
+def open_pq_index(vector_dir: os.PathLike):
+    mtime = os.stat(os.path.join(vector_dir, META_FILE)).st_mtime_ns
+    cached = _indexes.get(vector_dir)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, PQIndex(vector_dir))
+        _indexes[vector_dir] = cached
+    return cached[1]
+
+
+def evaluate(vector_dir: os.PathLike, k: int, reranks, num_queries: int = 100, seed: int = 0):
+    # recall@k and latency against the exact scan of the store, on preference-like queries
+    index = open_pq_index(vector_dir)
+    store = index.store
+    rng = np.random.default_rng(seed)
+    queries = np.stack([store[np.sort(rng.choice(len(store), min(20, len(store)), replace=False))].sum(axis=0) for _ in range(num_queries)])
+    queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    start = time.perf_counter()
+    exact = [set(select_top(store.scores(q), k).tolist()) for q in queries]
+    exact_latency = (time.perf_counter() - start) / num_queries * 1000
+    print(f"exact        latency={exact_latency:.3f}ms ({store.embeds.nbytes // len(store)} bytes/user)")
+    for rerank in reranks:
+        start = time.perf_counter()
+        results = [index.search(q, k, rerank=rerank)[0] for q in queries]
+        latency = (time.perf_counter() - start) / num_queries * 1000
+        recall = np.mean([len(truth & set(rows.tolist())) / k for truth, rows in zip(exact, results)])
+        print(f"rerank={rerank:<6} recall@{k}={recall:.4f} latency={latency:.3f}ms ({index.num_subspaces} bytes/user)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectorized-follower-dir', type=str, required=True)
+    parser.add_argument('--num-subspaces', type=int, default=32, help='bytes per user, must divide the embedding dim')
+    parser.add_argument('--num-iters', type=int, default=15)
+    parser.add_argument('--sample-size', type=int, default=20000, help='rows the codebooks are trained on')
+    parser.add_argument('--eval-k', type=int, default=10)
+    parser.add_argument('--eval-rerank', type=int, nargs='*', default=[0, 50, 200, 1000], help='candidates rescored with the store rows, 0 for codes only')
+    parser.add_argument('--skip-build', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_build:
+        build_pq_index(args.vectorized_follower_dir, args.num_subspaces, args.num_iters, args.sample_size)
+    evaluate(args.vectorized_follower_dir, args.eval_k, args.eval_rerank)
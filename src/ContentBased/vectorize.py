@@ -1,13 +1,20 @@
 import os
 import json
+import time
+import hashlib
 from tqdm import tqdm
 import torch
 import argparse
 import shutil
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import torch.nn.functional as F
 from torch import Tensor
 from transformers import AutoTokenizer, AutoModel
-from preprocess import load_user_feature_text
+from preprocess import iter_user_feature_text, iter_user_files, load_single_feature_text
+from snapshot import current_snapshot, open_snapshot
+from embed_store import ChunkIndexWriter, live_rows, load_chunk_info
 
 
 def average_pool(
@@ -18,47 +25,311 @@ def average_pool(
     return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
 
 
+def make_length_batches(lengths, max_batch_tokens: int):
+    # sort by token length and cut batches by padded size (rows x longest row) instead of row count
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    for i in order:
+        if current and (len(current) + 1) * lengths[i] > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_texts(model, tokenizer, texts, max_batch_tokens: int, device, max_length: int = 512):
+    encoded = tokenizer(texts, max_length=max_length, truncation=True)
+    lengths = [len(ids) for ids in encoded['input_ids']]
+
+    embeddings = None
+    with torch.inference_mode():
+        for batch in make_length_batches(lengths, max_batch_tokens):
+            batch_dict = tokenizer.pad(
+                {key: [encoded[key][i] for i in batch] for key in encoded.keys()},
+                padding=True,
+                return_tensors='pt'
+            )
+            batch_dict = {key: value.to(device) for key, value in batch_dict.items()}
+
+            outputs = model(**batch_dict)
+            batch_embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
+
+            # (Optionally) normalize embeddings
+            batch_embeddings = F.normalize(batch_embeddings, p=2, dim=1)
+
+            # scatter back to the original order
+            if embeddings is None:
+                embeddings = torch.empty(len(texts), batch_embeddings.shape[1], dtype=batch_embeddings.dtype, device=batch_embeddings.device)
+            embeddings[torch.tensor(batch, device=embeddings.device)] = batch_embeddings
+            del outputs
+    return embeddings
+
+
+# int8 dynamic quantization must keep every embedding at least this close (cosine) to its fp32 counterpart
+QUANTIZE_COSINE_TOLERANCE = 0.99
+
+
+def load_model(embed_model, device, quantize: bool = False, check_texts=None, max_batch_tokens: int = 16384):
+    tokenizer = AutoTokenizer.from_pretrained(embed_model)
+    model = AutoModel.from_pretrained(embed_model).to(device).eval()
+    if not quantize:
+        return tokenizer, model
+
+    if torch.device(device).type != 'cpu':
+        raise ValueError("int8 dynamic quantization is only supported with --device cpu")
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    # compare against the fp32 model on a sample so existing indexes stay usable
+    if check_texts:
+        reference = embed_texts(model, tokenizer, check_texts, max_batch_tokens, device)
+        approx = embed_texts(quantized, tokenizer, check_texts, max_batch_tokens, device)
+        min_cosine = (reference * approx).sum(dim=1).min().item()
+        print(f"[!] int8 vs fp32 min cosine on {len(check_texts)} texts: {min_cosine:.4f}")
+        if min_cosine < QUANTIZE_COSINE_TOLERANCE:
+            raise ValueError(f"int8 embeddings drift below cosine {QUANTIZE_COSINE_TOLERANCE} from fp32, rerun without --quantize")
+    del model
+    return tokenizer, quantized
+
+
+def feature_hash(embed_model, feature):
+    # an embedding is stale when either its text or the model that produced it changed
+    return hashlib.sha1(f"{embed_model}\0{feature}".encode('utf-8')).hexdigest()
+
+
+def chunk_hashes(chunk_info, embed_model):
+    # chunks written before hashes were recorded are assumed to come from the current model
+    if 'hashes' in chunk_info:
+        return chunk_info['hashes']
+    return [feature_hash(embed_model, feature) for feature in chunk_info['features']]
+
+
+def save_chunk_info(chunk_info, chunk_info_file):
+    # feature text goes to the optional chunk_text sidecar, chunk metadata stays small
+    chunk_info = {key: value for key, value in chunk_info.items() if key != 'features'}
+    tmp_file = chunk_info_file + '.tmp'
+    with open(tmp_file, 'w+', encoding='utf-8') as f:
+        json.dump(obj=chunk_info, fp=f, indent=4, ensure_ascii=False)
+    os.replace(tmp_file, chunk_info_file)
+
+
+def chunk_text_file(output_dir, chunk_id: int):
+    return os.path.join(output_dir, f"chunk_text_{chunk_id:>04d}.json")
+
+
+def load_chunk_text(output_dir, chunk_id: int, chunk_info=None):
+    # sidecar written with --save-features, or the text still embedded in an older chunk_info
+    if os.path.exists(chunk_text_file(output_dir, chunk_id)):
+        with open(chunk_text_file(output_dir, chunk_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    if chunk_info is not None and 'features' in chunk_info:
+        return chunk_info['features']
+    return None
+
+
+def save_chunk_text(output_dir, chunk_id: int, features):
+    tmp_file = chunk_text_file(output_dir, chunk_id) + '.tmp'
+    with open(tmp_file, 'w+', encoding='utf-8') as f:
+        json.dump(obj=features, fp=f, ensure_ascii=False)
+    os.replace(tmp_file, chunk_text_file(output_dir, chunk_id))
+
+
+def save_chunk(embeddings, chunk_file):
+    tmp_file = chunk_file + '.tmp'
+    torch.save(obj=embeddings, f=tmp_file)
+    os.replace(tmp_file, chunk_file)
+
+
+def indexed_prefix(chunk_info, embed_index):
+    # a crash after a chunk was rewritten but before its index record was appended leaves
+    # unindexed rows at its end; they are dropped and embedded again
+    tombstones = set(chunk_info.get('tombstones', []))
+    for row, user in enumerate(chunk_info['users']):
+        if row not in tombstones and embed_index.get(user) != chunk_info['id']:
+            return row
+    return len(chunk_info['users'])
+
+
+def vectorize_chunks(chunks, args, tokenizer, model, first_chunk_info=None, on_chunk_written=None, show_progress=True):
+    # texts of a window of chunks are length-bucketed together, chunks are still written one by one
+    num_embedded = 0
+    windows = range(0, len(chunks), args.window_chunks)
+    for window_start in tqdm(windows, disable=not show_progress):
+        window = chunks[window_start: window_start + args.window_chunks]
+        input_texts = [feature for batch in window for feature in batch['features']]
+        if not input_texts:
+            continue
+        window_embeddings = embed_texts(model, tokenizer, input_texts, args.max_batch_tokens, args.device)
+        num_embedded += len(input_texts)
+
+        offset = 0
+        for batch in window:
+            embeddings = window_embeddings[offset: offset + len(batch['features'])]
+            offset += len(batch['features'])
+
+            chunk_info_file = os.path.join(args.output_dir, f"chunk_info_{batch['id']:>04d}.json")
+            chunk_file = os.path.join(args.output_dir, f"chunk_{batch['id']:>04d}.bin")
+            features = batch['features']
+            batch = dict(batch, model=args.embed_model, hashes=[feature_hash(args.embed_model, feature) for feature in features])
+            if first_chunk_info is not None and batch['id'] == first_chunk_info['id']:
+                num_prev = len(first_chunk_info['users'])
+                batch = {
+                    "id": batch['id'],
+                    "users": first_chunk_info['users'] + batch['users'],
+                    "model": args.embed_model,
+                    "hashes": chunk_hashes(first_chunk_info, args.embed_model)[:num_prev] + batch['hashes'],
+                    "tombstones": first_chunk_info.get('tombstones', [])
+                }
+                if args.save_features:
+                    prev_features = load_chunk_text(args.output_dir, batch['id'], first_chunk_info) or [None] * num_prev
+                    features = prev_features[:num_prev] + features
+                prev_embeddings = torch.load(chunk_file, map_location=args.device)[:num_prev]
+                embeddings = torch.cat([prev_embeddings, embeddings], dim=0)
+
+            # chunk files are replaced atomically and the index record is appended last
+            save_chunk(embeddings.detach().clone(), chunk_file)
+            if args.save_features:
+                save_chunk_text(args.output_dir, batch['id'], features)
+            save_chunk_info(batch, chunk_info_file)
+
+            if on_chunk_written is not None:
+                on_chunk_written(batch)
+
+        del window_embeddings
+    return num_embedded
+
+
+def iter_windows(pending, first_chunk_id: int, first_chunk_size: int, chunk_size: int, window_chunks: int):
+    # group streamed (user, feature) pairs into chunks and chunks into windows, nothing else is kept in memory
+    window = []
+    chunk = {"id": first_chunk_id, "users": [], "features": []}
+    capacity = first_chunk_size
+    for user, feature in pending:
+        chunk['users'].append(user)
+        chunk['features'].append(feature)
+        if len(chunk['users']) >= capacity:
+            window.append(chunk)
+            chunk = {"id": chunk['id'] + 1, "users": [], "features": []}
+            capacity = chunk_size
+            if len(window) >= window_chunks:
+                yield window
+                window = []
+    if chunk['users']:
+        window.append(chunk)
+    if window:
+        yield window
+
+
+def refresh_changed(args, index_writer, current_hashes, load_text, get_model):
+    # re-embed users whose text (or the model) changed in place, tombstone users that disappeared
+    embed_index = index_writer.index
+    changed = {}
+    removed = {}
+    for chunk_id in sorted(set(embed_index.values())):
+        chunk_info = load_chunk_info(args.output_dir, chunk_id)
+        hashes = chunk_hashes(chunk_info, args.embed_model)
+        for row in live_rows(chunk_info):
+            user = chunk_info['users'][row]
+            if user not in current_hashes:
+                removed.setdefault(chunk_id, []).append(row)
+            elif hashes[row] != current_hashes[user]:
+                changed.setdefault(chunk_id, []).append(row)
+
+    num_changed = 0
+    for chunk_id in sorted(set(changed) | set(removed)):
+        chunk_info = load_chunk_info(args.output_dir, chunk_id)
+        chunk_info['hashes'] = chunk_hashes(chunk_info, args.embed_model)
+        chunk_info['model'] = args.embed_model
+        chunk_file = os.path.join(args.output_dir, f"chunk_{chunk_id:>04d}.bin")
+
+        features = load_chunk_text(args.output_dir, chunk_id, chunk_info)
+        rows = changed.get(chunk_id, [])
+        if rows:
+            # only the changed users are read again
+            texts = [load_text(chunk_info['users'][row]) for row in rows]
+            tokenizer, model = get_model(texts)
+            chunk_embed = torch.load(chunk_file, map_location=args.device)
+            chunk_embed[rows] = embed_texts(model, tokenizer, texts, args.max_batch_tokens, args.device).to(chunk_embed.dtype)
+            for row, text in zip(rows, texts):
+                chunk_info['hashes'][row] = feature_hash(args.embed_model, text)
+                if features is not None:
+                    features[row] = text
+            save_chunk(chunk_embed, chunk_file)
+            num_changed += len(rows)
+
+        if features is not None and (args.save_features or os.path.exists(chunk_text_file(args.output_dir, chunk_id))):
+            save_chunk_text(args.output_dir, chunk_id, features)
+        chunk_info['tombstones'] = sorted(set(chunk_info.get('tombstones', [])) | set(removed.get(chunk_id, [])))
+        save_chunk_info(chunk_info, os.path.join(args.output_dir, f"chunk_info_{chunk_id:>04d}.json"))
+        index_writer.remove([chunk_info['users'][row] for row in removed.get(chunk_id, [])])
+
+    num_removed = sum(len(rows) for rows in removed.values())
+    return num_changed, num_removed
+
+
+_worker_state = {}
+
+
+def init_worker(args, num_threads, check_texts):
+    # runs once per worker process: own model copy and thread budget
+    torch.set_num_threads(num_threads)
+    _worker_state['args'] = args
+    _worker_state['model'] = load_model(args.embed_model, args.device, args.quantize, check_texts, args.max_batch_tokens)
+
+
+def vectorize_window(chunks, first_chunk_info):
+    # index entries are returned to the parent, which owns the index log
+    args = _worker_state['args']
+    tokenizer, model = _worker_state['model']
+    written = []
+    num_embedded = vectorize_chunks(
+        chunks, args, tokenizer, model, first_chunk_info,
+        on_chunk_written=lambda batch: written.append((batch['id'], batch['users'])),
+        show_progress=False
+    )
+    return num_embedded, written
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--embed-model', type=str, default='thenlper/gte-large-zh')
     parser.add_argument('--raw-data-dir', type=str, required=True)
     parser.add_argument('--output-dir', type=str, required=True)
     parser.add_argument('--chunk-size', type=int, default=50)
+    parser.add_argument('--max-batch-tokens', type=int, default=16384, help='padded tokens per inference batch')
+    parser.add_argument('--window-chunks', type=int, default=20, help='chunks whose texts are length-sorted together')
     parser.add_argument('--force-revectorize', action='store_true')
+    parser.add_argument('--refresh-changed', action='store_true', help='re-embed users whose feature text changed, tombstone removed users')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--quantize', action='store_true', help='int8 dynamic quantization of linear layers (cpu only)')
+    parser.add_argument('--quantize-check-size', type=int, default=16, help='texts compared against fp32 when quantizing')
+    parser.add_argument('--num-threads', type=int, default=None, help='intra-op threads for cpu inference (per worker)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, each with its own model copy')
+    parser.add_argument('--parse-workers', type=int, default=1, help='processes parsing follower json files')
+    parser.add_argument('--snapshot-dir', type=str, default=None, help='read feature text from a snapshot compiled by snapshot.py')
+    parser.add_argument('--save-features', action='store_true', help='keep each chunk\'s feature text in a chunk_text_XXXX.json sidecar')
+    parser.add_argument('--compact-every', type=int, default=64, help='index log records between compactions into index.npz')
     args = parser.parse_args()
+    # a snapshot older than the raw files would feed stale text (and stale hashes to --refresh-changed)
+    args.snapshot_dir = current_snapshot(args.snapshot_dir)
     
+    if args.num_threads is not None and args.workers == 1:
+        torch.set_num_threads(args.num_threads)
+
     # do cleaning
     if args.force_revectorize and os.path.isdir(args.output_dir):
         shutil.rmtree(args.output_dir)
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
-        
-    # load all user feature text
-    user_features = load_user_feature_text(args.raw_data_dir)
     
-    # load indices of vectorized user feature
-    embed_index_file = os.path.join(args.output_dir, 'index.json')
-    if os.path.exists(embed_index_file):
-        with open(embed_index_file, 'r+', encoding='utf-8') as f:
-            embed_index = json.load(f)
-    else:
-        embed_index = {}
-        
-    # collect user features to be vectorized
-    user_features_to_be_vectorized = {
-        "users": [],
-        "features": []
-    }
-    if args.force_revectorize:
-        user_features_to_be_vectorized = user_features
-    else:
-        for user, feature in zip(user_features['users'], user_features['features']):
-            if user not in embed_index:
-                user_features_to_be_vectorized['users'].append(user)
-                user_features_to_be_vectorized['features'].append(feature)
+    # load indices of vectorized user feature (compacted index + replayed log)
+    index_writer = ChunkIndexWriter(args.output_dir, args.compact_every)
+    embed_index = index_writer.index
     
     # handle incomplete last chunk
-    first_chunk_incomplete = False
+    first_chunk_info = None
     first_chunk_size = args.chunk_size
     if not args.force_revectorize:
         first_chunk_id = max([chunk_index for _, chunk_index in embed_index.items()]) if len(embed_index) != 0 else 0
@@ -67,68 +338,89 @@ if __name__ == "__main__":
             with open(first_chunk_info_file, 'r+', encoding='utf-8') as f:
                 first_chunk_info = json.load(f)
             
+            first_chunk_info['id'] = first_chunk_id
+            num_indexed = indexed_prefix(first_chunk_info, embed_index)
+            first_chunk_info['users'] = first_chunk_info['users'][:num_indexed]
+            first_chunk_info['hashes'] = chunk_hashes(first_chunk_info, args.embed_model)[:num_indexed]
+            first_chunk_info['tombstones'] = [row for row in first_chunk_info.get('tombstones', []) if row < num_indexed]
             if len(first_chunk_info['users']) < args.chunk_size:
                 first_chunk_size -= len(first_chunk_info['users'])
-                first_chunk_incomplete = True
-                
-                chunk_file = os.path.join(args.output_dir, f"chunk_{first_chunk_id:>04d}.bin")
-                first_chunk_embed = torch.load(chunk_file)
             else:
+                first_chunk_info = None
                 first_chunk_id += 1
     else:
         first_chunk_id = 0
-    
-    # split input data into chunks
-    batch_data = [{
-        "id": first_chunk_id,
-        "users": user_features_to_be_vectorized['users'][:first_chunk_size],
-        "features": user_features_to_be_vectorized['features'][:first_chunk_size]
-    }]
-    for i in range(first_chunk_size, len(user_features_to_be_vectorized['users']), args.chunk_size):
-        batch_data.append({
-            "id": batch_data[-1]['id'] + 1,
-            "users": user_features_to_be_vectorized['users'][i: i + args.chunk_size],
-            "features": user_features_to_be_vectorized['features'][i: i + args.chunk_size]
-        })
-    
-    # load model and tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(args.embed_model)
-    model = AutoModel.from_pretrained(args.embed_model).cuda()
-    
-    # inference
-    for i, batch in tqdm(enumerate(batch_data), total=len(batch_data)):
-        input_texts = batch['features']
-
-        # Tokenize the input texts
-        batch_dict = tokenizer(input_texts, max_length=512, padding=True, truncation=True, return_tensors='pt')
-        for key, value in batch_dict.items():
-            if isinstance(value, torch.Tensor):
-                batch_dict[key] = value.cuda()
-
-        outputs = model(**batch_dict)
-        embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
-
-        # (Optionally) normalize embeddings
-        embeddings = F.normalize(embeddings, p=2, dim=1)
-        
-        chunk_info_file = os.path.join(args.output_dir, f"chunk_info_{batch['id']:>04d}.json")
-        chunk_file = os.path.join(args.output_dir, f"chunk_{batch['id']:>04d}.bin")
-        if i == 0 and first_chunk_incomplete:
-            batch = {
-                "id": batch['id'],
-                "users": first_chunk_info['users'] + batch['users'],
-                "features": first_chunk_info['features'] + batch['features']
-            }
-            prev_embeddings = torch.load(chunk_file)
-            embeddings = torch.cat([prev_embeddings, embeddings], dim=0)
-        
-        with open(chunk_info_file, 'w+', encoding='utf-8') as f:
-            json.dump(obj=batch, fp=f, indent=4, ensure_ascii=False)
-        torch.save(obj=embeddings.detach(), f=chunk_file)
-        
-        with open(embed_index_file, 'w+', encoding='utf-8') as f:
-            for user in batch['users']:
-                embed_index[user] = batch['id']
-            json.dump(obj=embed_index, fp=f, indent=4, ensure_ascii=False)
-            
-        del outputs, embeddings
+
+    # stream user feature text file by file, only users to be vectorized are passed on
+    current_hashes = {}
+
+    def pending_features():
+        for user, feature in iter_user_feature_text(args.raw_data_dir, workers=args.parse_workers, snapshot_dir=args.snapshot_dir):
+            if args.refresh_changed:
+                current_hashes[user] = feature_hash(args.embed_model, feature)
+            if args.force_revectorize or user not in embed_index:
+                yield user, feature
+
+    windows = iter_windows(pending_features(), first_chunk_id, first_chunk_size, args.chunk_size, args.window_chunks)
+
+    # load model and tokenizer on first use
+    loaded = {}
+
+    def get_model(check_texts):
+        if 'model' not in loaded:
+            loaded['model'] = load_model(args.embed_model, args.device, args.quantize, check_texts[:args.quantize_check_size], args.max_batch_tokens)
+        return loaded['model']
+
+    num_embedded = 0
+    start_time = time.perf_counter()
+    if args.workers == 1:
+        def update_index(batch):
+            index_writer.add(batch['id'], batch['users'])
+
+        for window in tqdm(windows):
+            tokenizer, model = get_model([feature for batch in window for feature in batch['features']])
+            num_embedded += vectorize_chunks(window, args, tokenizer, model, first_chunk_info, on_chunk_written=update_index, show_progress=False)
+    else:
+        # windows go to the pool as they are streamed in, every worker writes its own chunk files;
+        # the parent appends their index records as windows finish
+        num_threads = args.num_threads or max(1, (os.cpu_count() or 1) // args.workers)
+        first_window = next(windows, None)
+        if first_window is not None:
+            check_texts = [feature for batch in first_window for feature in batch['features']][:args.quantize_check_size]
+            with ProcessPoolExecutor(
+                max_workers=args.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(args, num_threads, check_texts)
+            ) as executor:
+                in_flight = []
+
+                def collect(future):
+                    window_embedded, written = future.result()
+                    for chunk_id, users in written:
+                        index_writer.add(chunk_id, users)
+                    return window_embedded
+
+                for window in tqdm(itertools.chain([first_window], windows)):
+                    in_flight.append(executor.submit(vectorize_window, window, first_chunk_info))
+                    # bound the number of windows held in memory
+                    while len(in_flight) >= 2 * args.workers:
+                        num_embedded += collect(in_flight.pop(0))
+                for future in in_flight:
+                    num_embedded += collect(future)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"[!] embedded {num_embedded} users in {elapsed:.1f}s ({num_embedded / max(elapsed, 1e-9):.2f} embeddings/sec on {args.device})")
+
+    if args.refresh_changed and not args.force_revectorize:
+        if args.snapshot_dir is not None:
+            snapshot = open_snapshot(args.snapshot_dir)
+            profiles = {snapshot.profile_name(profile).split('.')[0]: profile for profile in snapshot.profiles_in(args.raw_data_dir)}
+            load_text = lambda user: snapshot.feature_text(profiles[user])[0]
+        else:
+            user_files = dict(iter_user_files(args.raw_data_dir))
+            load_text = lambda user: load_single_feature_text(user_files[user])[0]
+        num_changed, num_removed = refresh_changed(args, index_writer, current_hashes, load_text, get_model)
+        print(f"[!] refreshed {num_changed} changed users in place, tombstoned {num_removed} removed users")
+
+    index_writer.close()